@@ -1,13 +1,26 @@
 """Create a connection to Board Game Arena and interact with it."""
+import asyncio
+import codecs
+import email.utils
+import http.cookiejar
+import http.cookies
 import json
 import logging
+import random
 from logging.handlers import RotatingFileHandler
 import re
 import time
 import urllib.parse
 
-import requests
-from bga_game_list import get_game_list
+import aiohttp
+from yarl import URL
+from bga_health import bga_circuit, bga_latency, get_endpoint, hedge, UNAVAILABLE_MSG, BGAUnavailableError
+from bga_game_list import get_game_list, get_game_index
+from bga_player_cache import player_id_cache
+from bga_ratelimit import request_scheduler, request_priority
+from singleflight import SingleFlight
+from ttl_cache import TTLCache
+from utils import normalize_name
 
 LOG_FILENAME = "errs"
 logger = logging.getLogger(__name__)
@@ -49,6 +62,159 @@ LEVEL_VALUES = [
     "expert",
     "master",
 ]
+LEVEL_NUMBERS = {level: i for i, level in enumerate(LEVEL_VALUES)}
+# BGA includes this text in pages and ajax errors when the session is not logged in
+NOT_LOGGED_IN_TEXT = "You must be logged in"
+
+# Patterns for fields in BGA pages, read with fetch_fields
+STREAM_CHUNK_SIZE = 16384
+STREAM_OVERLAP = 1024
+GROUP_SELECT_OVERLAP = 65536
+GAME_PROGRESSION_RE = re.compile(r'updateGameProgression":"([^"]*)"')
+MOVE_NBR_RE = re.compile(r'move_nbr":"([^"]*)"')
+# Some version of "You are playing" or "Playing now at:". The trailing \D is so we never match half of an id.
+PLAYING_AT_TABLE_RE = re.compile(r"[Pp]laying[^<]*<a href=\"\/table\?table=(\d+)\D")
+RESTRICT_GROUP_RE = re.compile(r'<select id="restrictToGroup">([\s\S]*?)<\/select>')
+
+
+# Identical concurrent reads of public data (players, tables) share one request, whichever session makes it.
+bga_reads = SingleFlight()
+# Turn based tables change every few minutes at most, so table lists and table pages can be reused for a bit.
+TABLES_CACHE_TTL = 120
+TABLE_METADATA_CACHE_TTL = 120
+tables_cache = TTLCache(TABLES_CACHE_TTL, max_entries=2000)
+table_metadata_cache = TTLCache(TABLE_METADATA_CACHE_TTL, max_entries=5000)
+# {lowercase BGA username: [(group id, group name)]}. Groups rarely change, and a miss reads them again.
+GROUP_OPTIONS_CACHE_TTL = 3600
+group_options_cache = TTLCache(GROUP_OPTIONS_CACHE_TTL, max_entries=5000)
+
+# Reads that fail (timeouts, connection errors, 5xx) are retried with jittered exponential backoff
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+
+# All BGA sessions share one connector so that TCP/TLS connections and DNS lookups are reused
+# across users. Each session keeps its own cookie jar.
+CONNECTOR_LIMIT = 100
+CONNECTOR_LIMIT_PER_HOST = 30
+CONNECTOR_DNS_TTL = 300
+CONNECTOR_KEEPALIVE = 30
+_connector = None
+
+
+def get_shared_connector():
+    """Get the process-wide connector, creating it on first use (must be called from the event loop)."""
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(
+            limit=CONNECTOR_LIMIT,
+            limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+            ttl_dns_cache=CONNECTOR_DNS_TTL,
+            keepalive_timeout=CONNECTOR_KEEPALIVE,
+        )
+    return _connector
+
+
+async def close_shared_connector():
+    """Close the shared connector on shutdown."""
+    global _connector
+    if _connector is not None and not _connector.closed:
+        await _connector.close()
+    _connector = None
+
+
+async def read_text(response):
+    return await response.text()
+
+
+def compile_options(options):
+    """Validate table options and turn them into a list of option requests ({"path": ..., "params": ...}).
+    This doesn't depend on the table, so the result can be reused for every table with the same options.
+    A restrictgroup request has the group name in "group" until resolve_option_plan finds its id.
+    Returns the list or an error string."""
+    # Set defaults if they're not present
+    defaults = {
+        "mode": "normal",
+        "presentation": "Made by discord BGA bot (github.com/pocc/bga_discord)",
+    }
+    # options will overwrite defaults if they are there
+    defaults.update(options)
+    updated_options = defaults
+    url_data = []
+    for option in updated_options:
+        value = updated_options[option]
+        option_data = {}
+        logger.debug(f"Reading option `{option}` with key `{value}`")
+        if option == "mode":
+            option_data["path"] = "/table/table/changeoption.html"
+            mode_name = updated_options[option]
+            if mode_name not in list(MODE_TYPES.keys()):
+                return f"Valid modes are training and normal. You entered {mode_name}."
+            mode_id = MODE_TYPES[mode_name]
+            option_data["params"] = {"id": 201, "value": mode_id}
+        elif option == "speed":
+            option_data["path"] = "/table/table/changeoption.html"
+            speed_name = updated_options[option]
+            if speed_name not in list(SPEED_TYPES.keys()):
+                return f"{speed_name} is not a valid speed. Check !bga options."
+            speed_id = SPEED_TYPES[speed_name]
+            option_data["params"] = {"id": 200, "value": speed_id}
+        elif option == "minrep":
+            option_data["path"] = "/table/table/changeTableAccessReputation.html"
+            if value not in list(KARMA_TYPES.keys()):
+                return f"Invalid minimum karma {value}. Valid values are 0, 50, 65, 75, 85."
+            option_data["params"] = {"karma": KARMA_TYPES[value]}
+        elif option == "presentation":
+            # No error checking is necessary as every string is valid.
+            option_data["path"] = "/table/table/setpresentation.html"
+            option_data["params"] = {"value": updated_options[option]}
+        elif option == "levels":
+            if "-" not in value:
+                return "levels requires a dash between levels like `good-strong`."
+            [min_level, max_level] = value.lower().split("-")
+            if min_level not in LEVEL_VALUES:
+                return f"Min level {min_level} is not a valid level ({','.join(LEVEL_VALUES)})"
+            if max_level not in LEVEL_VALUES:
+                return f"Max level {max_level} is not a valid level ({','.join(LEVEL_VALUES)})"
+            min_level_num = LEVEL_NUMBERS[min_level]
+            max_level_num = LEVEL_NUMBERS[max_level]
+            level_keys = {}
+            for i in range(7):
+                if min_level_num <= i <= max_level_num:
+                    level_keys["level" + str(i)] = "true"
+                else:
+                    level_keys["level" + str(i)] = "false"
+            option_data["path"] = "/table/table/changeTableAccessLevel.html"
+            option_data["params"] = level_keys
+        elif option == "players":
+            # Change minimum and maximum number of players
+            option_data["path"] = "/table/table/changeWantedPlayers.html"
+            [minp, maxp] = updated_options[option].split("-")
+            option_data["params"] = {"minp": minp, "maxp": maxp}
+        elif option == "restrictgroup":
+            # The group id can only be found once there's a table (see BGAAccount.resolve_option_plan)
+            option_data["path"] = "/table/table/restrictToGroup.html"
+            option_data["group"] = value
+        elif option == "lang":
+            option_data["path"] = "/table/table/restrictToLanguage.html"
+            option_data["params"] = {"lang": updated_options[option]}
+        elif option.isdigit():
+            # If this is an HTML option, set it as such
+            option_data["path"] = "/table/table/changeoption.html"
+            option_data["params"] = {"id": option, "value": updated_options[option]}
+        else:
+            return f"Option {option} not a valid option."
+
+        url_data.append(option_data)
+    return url_data
+
+
+def match_group(group_name, group_options):
+    """Get the id of the last group whose name starts with group_name, or -1."""
+    group_id = -1
+    for group_o in group_options:
+        if group_o[1].startswith(group_name):
+            group_id = group_o[0]
+    return group_id
 
 
 class BGAAccount:
@@ -56,35 +222,149 @@ class BGAAccount:
 
     def __init__(self):
         self.base_url = "https://boardgamearena.com"
-        self.session = requests.Session()
-        # Get CSRF token from login pagetext
-        resp = self.session.get(self.base_url + "/account")
-        resp_text = resp.text
-        # example: <input type='hidden' name='request_token' id='request_token' value='soJoMkn9CHYUDg6' />
-        request_token_match = re.search(r"id='request_token' value='([0-9a-f]*)'", resp_text)
-        if not request_token_match:
-            print("Error text\n" + resp_text)  # Return error condition
-            return False
-        self.request_token = request_token_match[1]
+        self.session = aiohttp.ClientSession(connector=get_shared_connector(), connector_owner=False)
+        self.request_token = ""
+        # Kept so that a long-lived (pooled) session can log in again when BGA expires it
+        self.username = ""
+        self.password = ""
+        self.logged_in = False
+        self.login_count = 0
+        self.saved_login_count = 0  # login_count when the cookies were last saved (see creds_iface.save_cookies)
+        self.login_lock = asyncio.Lock()
+
+    async def wait_for_rate_limit(self):
+        """Wait until this account may send another request to BGA, at the priority of the current task."""
+        await request_scheduler.acquire(self.username or id(self), request_priority.get())
 
-    def fetch(self, url):
-        """Generic get."""
+    async def fetch(self, url, idempotent=False):
+        """Generic get. Only pass idempotent for reads, as those may be retried or sent twice."""
         logger.debug("\nGET: " + url)
-        with self.session.get(url) as response:
-            resp_text = response.text
-            if resp_text[0] in ["{", "["]:  # If it's a json
-                print(f"Fetched {url}. Resp: " + resp_text[:80])
-            return resp_text
+        resp_text = await self.send("GET", url, idempotent=idempotent)
+        if await self.relogin_if_expired(resp_text):
+            resp_text = await self.send("GET", url, idempotent=idempotent)
+        if resp_text[:1] in ["{", "["]:  # If it's a json
+            print(f"Fetched {url}. Resp: " + resp_text[:80])
+        return resp_text
 
-    def post(self, url, params):
+    async def post(self, url, params):
         """Generic post."""
-        with self.session.post(url, data=params) as response:
-            resp_text = response.text
-            print(f"Posted {url}. Resp: " + resp_text[:80])
+        resp_text = await self.send("POST", url, params)
+        if await self.relogin_if_expired(resp_text):
+            resp_text = await self.send("POST", url, params)
+        print(f"Posted {url}. Resp: " + resp_text[:80])
+        return resp_text
+
+    async def fetch_fields(self, url, patterns, overlap=STREAM_OVERLAP):
+        """GET a page, but only read it until every pattern has matched, then drop the connection.
+        Each chunk is searched together with the last `overlap` chars of the previous ones so matches can span chunks.
+        Returns {name: match or None} for {name: compiled pattern}."""
+        logger.debug("\nGET (streaming): " + url)
 
-    def login(self, username, password):
+        async def read_fields(response):
+            matches = {name: None for name in patterns}
+            is_expired = False
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            window = ""
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                window = window[-overlap:] + decoder.decode(chunk)
+                for name, pattern in patterns.items():
+                    if matches[name] is None:
+                        matches[name] = pattern.search(window)
+                is_expired = self.logged_in and NOT_LOGGED_IN_TEXT in window
+                if is_expired or all(matches.values()):
+                    response.close()  # Don't download the rest of the page
+                    break
+            return matches, is_expired
+
+        matches, is_expired = await self.send("GET", url, idempotent=True, read_response=read_fields)
+        # Retry only once, like fetch and post, so a page that always says it isn't logged in can't loop logins
+        if is_expired and await self.relogin_if_expired(NOT_LOGGED_IN_TEXT):
+            matches, _ = await self.send("GET", url, idempotent=True, read_response=read_fields)
+        return matches
+
+    async def send(self, method, url, params=None, idempotent=False, read_response=read_text):
+        """Send a request with a timeout based on how long this endpoint usually takes.
+        Idempotent requests are retried with jittered backoff and hedged when they are slower than usual.
+        Raises BGAUnavailableError if BGA doesn't answer or is known to be down."""
+        endpoint = get_endpoint(url)
+        attempts = RETRY_ATTEMPTS if idempotent else 1
+        for attempt in range(attempts):
+            bga_circuit.check()
+            try:
+                if idempotent:
+                    # The hedge delay is how long BGA takes to answer, so start the clock once the request can be sent.
+                    # Don't add a second request while others are waiting for the rate limit.
+                    await self.wait_for_rate_limit()
+                    result = await hedge(
+                        lambda: self.send_once(method, url, params, endpoint, read_response, rate_limited=True),
+                        bga_latency.hedge_delay(endpoint),
+                        make_hedge=lambda: self.send_once(method, url, params, endpoint, read_response),
+                        can_hedge=lambda: not request_scheduler.is_saturated(),
+                    )
+                else:
+                    result = await self.send_once(method, url, params, endpoint, read_response)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                logger.warning(f"{method} {url} failed (attempt {attempt + 1}/{attempts}): {e!r}")
+                if attempt + 1 == attempts:
+                    # One failure per request, not per retry or hedge, so one bad url can't open the breaker
+                    if bga_circuit.counts(endpoint):
+                        bga_circuit.record_failure()
+                    raise BGAUnavailableError(UNAVAILABLE_MSG) from e
+                await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+                continue
+            if bga_circuit.counts(endpoint):
+                bga_circuit.record_success()
+            return result
+
+    async def send_once(self, method, url, params, endpoint, read_response, rate_limited=False):
+        """Send a request once. Pass rate_limited if the caller already waited for the rate limit."""
+        if not rate_limited:
+            await self.wait_for_rate_limit()
+        timeout = bga_latency.timeout(endpoint)
+        start = time.monotonic()
+        try:
+            async with self.session.request(
+                method, url, data=params, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status >= 500:
+                    response.raise_for_status()
+                result = await read_response(response)
+        except asyncio.TimeoutError:
+            # Count the timeout as a latency so that timeouts grow when BGA is slow for everyone
+            bga_latency.record(endpoint, timeout)
+            raise
+        bga_latency.record(endpoint, time.monotonic() - start)
+        return result
+
+    async def relogin_if_expired(self, resp_text):
+        """If BGA says this session is no longer logged in, log in again.
+        Returns whether the request should be retried."""
+        if not self.logged_in or NOT_LOGGED_IN_TEXT not in resp_text:
+            return False
+        login_count = self.login_count
+        async with self.login_lock:
+            if self.login_count != login_count:  # A concurrent request already logged in again
+                return self.logged_in
+            logger.debug(f"BGA session for {self.username} expired. Logging in again.")
+            return await self.login(self.username, self.password)
+
+    async def get_request_token(self):
+        """Get CSRF token from login page text."""
+        resp_text = await self.fetch(self.base_url + "/account", idempotent=True)
+        # example: <input type='hidden' name='request_token' id='request_token' value='soJoMkn9CHYUDg6' />
+        request_token_match = re.search(r"id='request_token' value='([0-9a-f]*)'", resp_text)
+        if not request_token_match:
+            logger.error("Unable to find request token in text:\n" + resp_text[:1000])
+            return ""
+        return request_token_match[1]
+
+    async def login(self, username, password):
         """Login to BGA provided the username/password. The session will
         now have cookies to use for privileged actions."""
+        self.logged_in = False
+        self.request_token = await self.get_request_token()
+        if not self.request_token:
+            return False
         url = self.base_url + "/account/account/login.html"
         params = {
             "email": username,
@@ -96,22 +376,60 @@ class BGAAccount:
             "dojo.preventCache": str(int(time.time())),
         }
         logger.debug("LOGIN: " + url + "\nEMAIL: " + params["email"] + "\ncsrf_token:" + self.request_token)
-        self.post(url, params)
-        return self.verify_privileged()
+        await self.post(url, params)
+        self.logged_in = await self.verify_privileged()
+        if self.logged_in:
+            self.username, self.password = username, password
+            self.login_count += 1
+        return self.logged_in
 
-    def logout(self):
+    def export_cookies(self):
+        """Get this session's cookies as a list of dicts that can be saved and passed to restore_session.
+        "expires" is a unix timestamp, only there for cookies that expire."""
+        cookies = []
+        now = time.time()
+        for morsel in self.session.cookie_jar:
+            cookie = {"name": morsel.key, "value": morsel.value, "domain": morsel["domain"], "path": morsel["path"]}
+            expires = []
+            if morsel["expires"] and http.cookiejar.http2time(morsel["expires"]) is not None:
+                expires.append(http.cookiejar.http2time(morsel["expires"]))
+            if str(morsel["max-age"]).lstrip("-").isdigit():  # Only just received, so counted from now
+                expires.append(now + int(morsel["max-age"]))
+            if expires:
+                cookie["expires"] = min(expires)
+            cookies.append(cookie)
+        return cookies
+
+    def restore_session(self, username, password, cookies):
+        """Use the cookies of an earlier login instead of logging in. They aren't checked here:
+        if BGA rejects them, relogin_if_expired logs in again with the username and password.
+        Cookies that have expired since they were saved are skipped."""
+        for cookie in cookies:
+            if cookie.get("expires") and cookie["expires"] < time.time():
+                continue
+            jar = http.cookies.SimpleCookie()
+            jar[cookie["name"]] = cookie["value"]
+            jar[cookie["name"]]["path"] = cookie["path"]
+            if cookie.get("expires"):
+                jar[cookie["name"]]["expires"] = email.utils.formatdate(cookie["expires"], usegmt=True)
+            domain = cookie["domain"] or urllib.parse.urlsplit(self.base_url).hostname
+            jar[cookie["name"]]["domain"] = domain
+            self.session.cookie_jar.update_cookies(jar, response_url=URL("https://" + domain.lstrip(".")))
+        self.username, self.password = username, password
+        self.logged_in = True
+
+    async def logout(self):
         """Logout of current session."""
         url = self.base_url + "/account/account/logout.html"
         params = {"dojo.preventCache": str(int(time.time()))}
         url += "?" + urllib.parse.urlencode(params)
-        self.fetch(url)
+        self.logged_in = False
+        await self.fetch(url)
 
-    def quit_table(self):
+    async def quit_table(self):
         """Quit the table if the player is currently at one"""
         url = self.base_url + "/player"
-        resp = self.fetch(url)
-        # Some version of "You are playing" or "Playing now at:"
-        matches = re.search(r"[Pp]laying[^<]*<a href=\"\/table\?table=(\d+)", resp)
+        matches = (await self.fetch_fields(url, {"table": PLAYING_AT_TABLE_RE}))["table"]
         if matches is not None:
             table_id = matches[1]
             logger.debug("Quitting table" + str(table_id))
@@ -123,39 +441,31 @@ class BGAAccount:
                 "dojo.preventCache": str(int(time.time())),
             }
             quit_url += "?" + urllib.parse.urlencode(params)
-            self.fetch(quit_url)
+            await self.fetch(quit_url)
 
-    def quit_playing_with_friends(self):
+    async def quit_playing_with_friends(self):
         """There is a BGA feature called "playing with friends". Remove friends from the session"""
         quit_url = self.base_url + "/group/group/removeAllFromGameSession.html"
         params = {"dojo.preventCache": str(int(time.time()))}
         quit_url += "?" + urllib.parse.urlencode(params)
-        self.fetch(quit_url)
-
-    def create_table(self, game_name_part):
-        """Create a table and return its url. 201,0 is to set to normal mode.
-        Partial game names are ok, like race for raceforthegalaxy.
-        Returns (table id (int), error string (str))"""
-        # Try to close any logged-in session gracefully
-        lower_game_name = re.sub(r"[^a-z0-9]", "", game_name_part.lower())
-        self.quit_table()
-        self.quit_playing_with_friends()
-        games, err_msg = get_game_list()
+        await self.fetch(quit_url)
+
+    async def leave_current_tables(self):
+        """Quit the current table and the "playing with friends" session. They don't depend on each other."""
+        await asyncio.gather(self.quit_table(), self.quit_playing_with_friends())
+
+    def resolve_game_id(self, game_name_part):
+        """Find the id of a game from its (partial) name with the cached game list.
+        Returns (game id (int), error string (str))"""
+        lower_game_name = normalize_name(game_name_part)
+        _, err_msg = get_game_list()
         if len(err_msg) > 0:
             return -1, err_msg
-        lower_games = {}
-        for game in games:
-            lower_name = re.sub(r"[^a-z0-9]", "", game.lower())
-            lower_games[lower_name] = games[game]
-        # If name is unique like "race" for "raceforthegalaxy", use that
-        games_found = []
-        game_name = ""
-        for game_i in list(lower_games.keys()):
-            if game_i == lower_game_name:  # if there's an exact match, take it!
-                game_name = lower_game_name
-            elif game_i.startswith(lower_game_name):
-                games_found.append(game_i)
-        if len(game_name) == 0:
+        index = get_game_index()
+        game_id = index.get_id(lower_game_name)
+        if game_id == -1:  # if there's an exact match, take it!
+            # If name is unique like "race" for "raceforthegalaxy", use that
+            games_found = index.find_prefix(lower_game_name)
             if len(games_found) == 0:
                 err = (
                     f"`{lower_game_name}` is not available on BGA. Check your spelling "
@@ -165,8 +475,11 @@ class BGAAccount:
             elif len(games_found) > 1:
                 err = f"`{lower_game_name}` matches [{','.join(games_found)}]. Use more letters to match."
                 return -1, err
-            game_name = games_found[0]
-        game_id = lower_games[game_name]
+            game_id = index.get_id(games_found[0])
+        return game_id, ""
+
+    async def create_table_with_id(self, game_id):
+        """Create a table for a game id. Returns (table id (int), error string (str))"""
         url = self.base_url + "/table/table/createnew.html"
         params = {
             "game": game_id,
@@ -175,7 +488,7 @@ class BGAAccount:
             "dojo.preventCache": str(int(time.time())),
         }
         url += "?" + urllib.parse.urlencode(params)
-        resp = self.fetch(url)
+        resp = await self.fetch(url)
         try:
             resp_json = json.loads(resp)
         except json.decoder.JSONDecodeError:
@@ -190,114 +503,58 @@ class BGAAccount:
         table_id = resp_json["data"]["table"]
         return table_id, ""
 
-    def set_table_options(self, options, table_id):
-        url_data = self.parse_options(options, table_id)
-        if isinstance(url_data, str):  # In this case it's an error
-            return url_data
-        logger.debug("Got url data :" + str(url_data))
-        for url_datum in url_data:
-            self.set_option(table_id, url_datum["path"], url_datum["params"])
+    async def set_options(self, table_id, url_data, semaphore):
+        """Send option changes from resolve_option_plan at the same time, as many at once as the semaphore allows."""
+
+        async def set_option_bounded(url_datum):
+            async with semaphore:
+                await self.set_option(table_id, url_datum["path"], url_datum["params"])
+
+        await asyncio.gather(*[set_option_bounded(url_datum) for url_datum in url_data])
 
-    def set_option(self, table_id, path, params):
+    async def set_option(self, table_id, path, params):
         """Change the game options for the specified."""
         url = self.base_url + path
-        params.update({"table": table_id, "dojo.preventCache": str(int(time.time()))})
+        params = dict(params, table=table_id)
+        params["dojo.preventCache"] = str(int(time.time()))
         url += "?" + urllib.parse.urlencode(params)
-        self.fetch(url)
-
-    def parse_options(self, options, table_id):
-        """Create url data that can be parsed as urls"""
-        # Set defaults if they're not present
-        defaults = {
-            "mode": "normal",
-            "presentation": "Made by discord BGA bot (github.com/pocc/bga_discord)",
-        }
-        # options will overwrite defaults if they are there
-        defaults.update(options)
-        updated_options = defaults
-        url_data = []
-        for option in updated_options:
-            value = updated_options[option]
-            option_data = {}
-            logger.debug(f"Reading option `{option}` with key `{value}`")
-            if option == "mode":
-                option_data["path"] = "/table/table/changeoption.html"
-                mode_name = updated_options[option]
-                if mode_name not in list(MODE_TYPES.keys()):
-                    return f"Valid modes are training and normal. You entered {mode_name}."
-                mode_id = MODE_TYPES[mode_name]
-                option_data["params"] = {"id": 201, "value": mode_id}
-            elif option == "speed":
-                option_data["path"] = "/table/table/changeoption.html"
-                speed_name = updated_options[option]
-                if speed_name not in list(SPEED_TYPES.keys()):
-                    return f"{speed_name} is not a valid speed. Check !bga options."
-                speed_id = SPEED_TYPES[speed_name]
-                option_data["params"] = {"id": 200, "value": speed_id}
-            elif option == "minrep":
-                option_data["path"] = "/table/table/changeTableAccessReputation.html"
-                if value not in list(KARMA_TYPES.keys()):
-                    return f"Invalid minimum karma {value}. Valid values are 0, 50, 65, 75, 85."
-                option_data["params"] = {"karma": KARMA_TYPES[value]}
-            elif option == "presentation":
-                # No error checking is necessary as every string is valid.
-                option_data["path"] = "/table/table/setpresentation.html"
-                option_data["params"] = {"value": updated_options[option]}
-            elif option == "levels":
-                if "-" not in value:
-                    return "levels requires a dash between levels like `good-strong`."
-                [min_level, max_level] = value.lower().split("-")
-                if min_level not in LEVEL_VALUES:
-                    return f"Min level {min_level} is not a valid level ({','.join(LEVEL_VALUES)})"
-                if max_level not in LEVEL_VALUES:
-                    return f"Max level {max_level} is not a valid level ({','.join(LEVEL_VALUES)})"
-                level_enum = {LEVEL_VALUES[i]: i for i in range(len(LEVEL_VALUES))}
-                min_level_num = level_enum[min_level]
-                max_level_num = level_enum[max_level]
-                level_keys = {}
-                for i in range(7):
-                    if min_level_num <= i <= max_level_num:
-                        level_keys["level" + str(i)] = "true"
-                    else:
-                        level_keys["level" + str(i)] = "false"
-                option_data["path"] = "/table/table/changeTableAccessLevel.html"
-                option_data["params"] = level_keys
-            elif option == "players":
-                # Change minimum and maximum number of players
-                option_data["path"] = "/table/table/changeWantedPlayers.html"
-                [minp, maxp] = updated_options[option].split("-")
-                option_data["params"] = {"minp": minp, "maxp": maxp}
-            elif option == "restrictgroup":
-                option_data["path"] = "/table/table/restrictToGroup.html"
-                group_options = self.get_group_options(table_id)
-                group_id = -1
-                for group_o in group_options:
-                    if group_o[1].startswith(value):
-                        group_id = group_o[0]
-                if group_id != -1:
-                    option_data["params"] = {"group": group_id}
-                else:
-                    groups_str = "[`" + "`,`".join([g[1] for g in group_options if g[1] != "-"]) + "`]"
-                    return f"Unable to find group {value}. You are a member of groups {groups_str}."
-            elif option == "lang":
-                option_data["path"] = "/table/table/restrictToLanguage.html"
-                option_data["params"] = {"lang": updated_options[option]}
-            elif option.isdigit():
-                # If this is an HTML option, set it as such
-                option_data["path"] = "/table/table/changeoption.html"
-                option_data["params"] = {"id": option, "value": updated_options[option]}
-            else:
-                return f"Option {option} not a valid option."
+        await self.fetch(url)
 
-            url_data.append(option_data)
+    async def resolve_option_plan(self, plan, table_id):
+        """Fill in the group ids of an option plan from compile_options. Returns url data or an error string."""
+        url_data = []
+        for option_data in plan:
+            if "group" not in option_data:
+                url_data.append(option_data)
+                continue
+            group_id, group_options = await self.find_group(option_data["group"], table_id)
+            if group_id == -1:
+                groups_str = "[`" + "`,`".join([g[1] for g in group_options if g[1] != "-"]) + "`]"
+                return f"Unable to find group {option_data['group']}. You are a member of groups {groups_str}."
+            url_data.append({"path": option_data["path"], "params": {"group": group_id}})
         return url_data
 
-    def get_group_id(self, group_name):
+    async def find_group(self, group_name, table_id):
+        """Find the id of one of this user's groups by the start of its name.
+        The user's groups are cached, and only read again from the table page if the group isn't there.
+        Returns (group id or -1, [(group id, group name)])"""
+        key = self.username.lower()
+        group_options = group_options_cache.get(key)
+        if group_options is not None:
+            group_id = match_group(group_name, group_options)
+            if group_id != -1:
+                return group_id, group_options
+        # Not cached, or the user may have joined the group since the list was cached
+        group_options = await self.get_group_options(table_id)
+        group_options_cache.set(key, group_options)
+        return match_group(group_name, group_options), group_options
+
+    async def get_group_id(self, group_name):
         """For BGA groups of people."""
         uri_vars = {"q": group_name, "start": 0, "count": "Infinity"}
         group_uri = urllib.parse.urlencode(uri_vars)
         full_url = self.base_url + f"/group/group/findgroup.html?{group_uri}"
-        result_str = self.fetch(full_url)
+        result_str = await self.fetch(full_url, idempotent=True)
         result = json.loads(result_str)
         group_id = result["items"][0]["id"]  # Choose ID of first result
         logger.debug(f"Found {group_id} for group {group_name}")
@@ -307,31 +564,40 @@ class BGAAccount:
         """Given the table id, make the table url."""
         return self.base_url + "/table?table=" + str(table_id)
 
-    def verify_privileged(self):
+    async def verify_privileged(self):
         """Verify that the user is logged in by accessing a url they should have access to."""
-        community_text = self.fetch(self.base_url + "/community")
-        return "You must be logged in to see this page." not in community_text
+        community_text = await self.fetch(self.base_url + "/community", idempotent=True)
+        return NOT_LOGGED_IN_TEXT not in community_text
 
-    def get_group_options(self, table_id):
+    async def get_group_options(self, table_id):
         """The friend group id is unique to every user. Search the table HTML for it."""
         table_url = self.base_url + "/table?table=" + str(table_id)
-        html_text = self.fetch(table_url)
-        restrict_group_select = re.search(r'<select id="restrictToGroup">([\s\S]*?)<\/select>', html_text)[0]
+        fields = await self.fetch_fields(table_url, {"groups": RESTRICT_GROUP_RE}, overlap=GROUP_SELECT_OVERLAP)
+        restrict_group_select = fields["groups"][0]
         options = re.findall(r'"(\d*)">([^<]*)', restrict_group_select)
         return options
 
-    def get_player_id(self, player):
+    async def get_player_id(self, player):
         """Given the name of a player, get their player id."""
+        player_id = player_id_cache.get(player)
+        if player_id is not None:
+            return player_id
+        player_id = await bga_reads.do(("findplayer", player.lower()), self.find_player_id, player)
+        player_id_cache.set(player, player_id)
+        return player_id
+
+    async def find_player_id(self, player):
+        """Search BGA for the player id of a player name."""
         url = self.base_url + "/player/player/findplayer.html"
         params = {"q": player, "start": 0, "count": "Infinity"}
         url += "?" + urllib.parse.urlencode(params)
-        resp = self.fetch(url)
+        resp = await self.fetch(url, idempotent=True)
         resp_json = json.loads(resp)
         if len(resp_json["items"]) == 0:
             return -1
         return resp_json["items"][0]["id"]
 
-    def invite_player(self, table_id, player_id):
+    async def invite_player(self, table_id, player_id):
         """Invite a player to a table you are creating."""
         url = self.base_url + "/table/table/invitePlayer.html"
         params = {
@@ -340,7 +606,7 @@ class BGAAccount:
             "dojo.preventCache": str(int(time.time())),
         }
         url += "?" + urllib.parse.urlencode(params)
-        resp = self.fetch(url)
+        resp = await self.fetch(url)
         resp_json = json.loads(resp)
         if "status" in resp_json:
             if resp_json["status"] == "0":
@@ -350,43 +616,64 @@ class BGAAccount:
         else:
             raise IOError("Problem encountered: " + str(resp))
 
-    def add_friend(self, friend_name):
-        friend_id = self.get_player_id(friend_name)
+    async def add_friend(self, friend_name):
+        friend_id = await self.get_player_id(friend_name)
         if friend_id == -1:
             return f"Player {friend_name} not found. Make sure they exist and check spelling."
         params = {"id": friend_id, "dojo.preventCache": str(int(time.time()))}
         path = "?" + urllib.parse.urlencode(params)
-        self.fetch(self.base_url + "/community/community/addToFriend.html" + path)
+        await self.fetch(self.base_url + "/community/community/addToFriend.html" + path)
+
+    async def get_tables(self, player_id, fresh=False):
+        """Get all of the tables that a player is playing at. Tables are returned as json objects.
+        The result is shared with other callers, so don't change it. Use fresh to skip the cache."""
+        key = ("tables", str(player_id))
+        tables = None if fresh else tables_cache.get(key)
+        if tables is None:
+            if fresh:
+                bga_reads.forget(key)
+            tables = await bga_reads.do(key, self.fetch_tables, player_id)
+            tables_cache.set(key, tables)
+        return tables
 
-    def get_tables(self, player_id):
-        """Get all of the tables that a player is playing at. Tables are returned as json objects."""
+    async def fetch_tables(self, player_id):
         url = self.base_url + "/tablemanager/tablemanager/tableinfos.html"
         params = {"playerfilter": player_id, "dojo.preventCache": str(int(time.time()))}
         url += "?" + urllib.parse.urlencode(params)
-        resp = self.fetch(url)
+        resp = await self.fetch(url, idempotent=True)
         resp_json = json.loads(resp)
         return resp_json["data"]["tables"]
 
-    def get_table_metadata(self, table_data):
-        """Get the numbure of moves and progress of the game as strings"""
+    async def get_table_metadata(self, table_data, fresh=False):
+        """Get the numbure of moves and progress of the game as strings. Use fresh to skip the cache."""
+        key = ("table", str(table_data["id"]))
+        metadata = None if fresh else table_metadata_cache.get(key)
+        if metadata is None:
+            if fresh:
+                bga_reads.forget(key)
+            metadata = await bga_reads.do(key, self.fetch_table_metadata, table_data)
+            table_metadata_cache.set(key, metadata)
+        return metadata
+
+    async def fetch_table_metadata(self, table_data):
         table_id = table_data["id"]
         game_server = table_data["gameserver"]
         game_name = table_data["game_name"]
         table_url = f"{self.base_url}/{game_server}/{game_name}?table={table_id}"
-        resp = self.fetch(table_url)
-        game_progress_match = re.search('updateGameProgression":"([^"]*)"', resp)
+        fields = await self.fetch_fields(table_url, {"progress": GAME_PROGRESSION_RE, "moves": MOVE_NBR_RE})
+        game_progress_match = fields["progress"]
         if game_progress_match:
             game_progress = game_progress_match[1]
         else:
             game_progress = ""
-        num_moves_match = re.search('move_nbr":"([^"]*)"', resp)
+        num_moves_match = fields["moves"]
         if num_moves_match:
             num_moves = num_moves_match[1]
         else:
             num_moves = ""
         return game_progress, num_moves, table_url
 
-    def open_table(self, table_id):
+    async def open_table(self, table_id):
         """Function to open the table to other people for a specific table.
         You must have created the table to be able to use this function.
         example get url https://boardgamearena.com/table/table/openTableNow.html?table=121886720&dojo.preventCache=1604627527457
@@ -394,19 +681,19 @@ class BGAAccount:
         url = self.base_url + "/table/table/openTableNow.html"
         params = {"table": table_id, "dojo.preventCache": str(int(time.time()))}
         url += "?" + urllib.parse.urlencode(params)
-        self.fetch(url)
+        await self.fetch(url)
 
-    def message_player(self, player_name, msg_to_send):
+    async def message_player(self, player_name, msg_to_send):
         url = self.base_url + "/table/table/say_private.html"
-        player_id = self.get_player_id(player_name)
+        player_id = await self.get_player_id(player_name)
         if player_id == -1:
             return f"Player {player_name} not found, so message not sent."
         params = {"to": player_id, "msg": msg_to_send, "dojo.preventCache": str(int(time.time()))}
         url += "?" + urllib.parse.urlencode(params)
         logger.debug(f"Sending message to {player_name} with length {len(msg_to_send)}")
-        self.post(url, params)
+        await self.post(url, params)
         return "Message sent"
 
-    def close_connection(self):
+    async def close_connection(self):
         """Close the connection. aiohttp complains otherwise."""
-        self.session.close()
+        await self.session.close()
@@ -13,8 +13,6 @@ async def add_friends(friends, message):
         err_msg = await account.add_friend(friend)
         if err_msg:
             await message.channel.send(err_msg)
-            await account.close_connection()
             return
         else:
             await message.channel.send(f"{friend} added successfully as a friend.")
-    await account.close_connection()
@@ -0,0 +1,159 @@
+"""Create many BGA tables at once, like all of the tables for a round of a tournament.
+
+The pairings come from an attached CSV or JSON file, or from the lines of the message after the command.
+Every table is created with the organizer's pooled session, a few at a time, and the results are sent as one embed.
+
+CSV (or message lines): one table per row, like `game,player1,player2,speed:slow`
+JSON: [{"game": "azul", "players": ["player1", "player2"], "options": {"speed": "slow"}}, ...]
+"""
+import asyncio
+import csv
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import traceback
+
+from bga_create_game import create_table_for_players, merge_options
+from bga_health import BGAUnavailableError
+from bga_ratelimit import BGARateLimitError
+from creds_iface import get_active_session, get_login
+from discord_utils import send_summary_embed
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Max number of tables to create at the same time. Requests are also rate limited per BGA account.
+BULK_CONCURRENCY = 4
+MAX_BULK_TABLES = 100
+MAX_PAIRINGS_BYTES = 100000
+
+
+async def bulk_create_command(message):
+    """!bulk: read the pairings in the message and create their tables."""
+    if message.attachments and message.attachments[0].size > MAX_PAIRINGS_BYTES:
+        await message.channel.send(f"The pairings file is too big. It can be at most {MAX_PAIRINGS_BYTES // 1000} KB.")
+        return
+    text, filename = await read_pairings_text(message)
+    if not text.strip():
+        await message.channel.send(
+            "Attach a CSV or JSON file of pairings, or put one table per line after `!bulk`, "
+            "like `azul,player1,player2,speed:slow`.",
+        )
+        return
+    pairings, err = parse_pairings(text, filename)
+    if err:
+        await message.channel.send(err)
+        return
+    await bulk_create_games(message, str(message.author.id), pairings)
+
+
+async def read_pairings_text(message):
+    """Get the text of the first attachment, or else the lines of the message after the command.
+    Returns (text, filename)"""
+    if message.attachments:
+        attachment = message.attachments[0]
+        data = await attachment.read()
+        return data.decode("utf-8", errors="replace"), attachment.filename
+    return message.content.partition("\n")[2], ""
+
+
+def parse_pairings(text, filename=""):
+    """Parse pairings from JSON (a list of tables) or CSV (a row per table).
+    Returns ([{"game": str, "players": [str], "options": {str: str}}], error string)"""
+    if filename.lower().endswith(".json") or text.lstrip().startswith("["):
+        try:
+            tables = json.loads(text)
+        except json.decoder.JSONDecodeError as e:
+            return [], f"Unable to read the pairings as JSON: {e}"
+        pairings = []
+        for table in tables:
+            if not isinstance(table, dict) or not table.get("game"):
+                return [], f'Each table needs a game, like {{"game": "azul", "players": [...]}}. Got `{table}`.'
+            if not isinstance(table.get("options", {}), dict):
+                return [], f'Options need to be an object like {{"speed": "slow"}}. Got `{table["options"]}`.'
+            if not isinstance(table.get("players", []), list):
+                return [], f'Players need to be a list like ["player1", "player2"]. Got `{table["players"]}`.'
+            options = {str(k): str(v) for k, v in table.get("options", {}).items()}
+            players = [str(player) for player in table.get("players", [])]
+            pairings.append({"game": str(table["game"]), "players": players, "options": options})
+    else:
+        pairings = []
+        for row in csv.reader(text.splitlines()):
+            cells = [cell.strip() for cell in row if cell.strip()]
+            if not cells or cells[0].startswith("#") or cells[0].lower() == "game":  # Blank, comment or header
+                continue
+            options = {}
+            players = []
+            for cell in cells[1:]:
+                if ":" in cell:  # Same syntax as !play
+                    key, value = cell.split(":")[:2]
+                    options[key] = value
+                else:
+                    players.append(cell)
+            pairings.append({"game": cells[0], "players": players, "options": options})
+    if not pairings:
+        return [], "No tables found in the pairings."
+    if len(pairings) > MAX_BULK_TABLES:
+        return [], f"Found {len(pairings)} tables, but at most {MAX_BULK_TABLES} can be created at once."
+    return pairings, ""
+
+
+async def bulk_create_games(message, discord_id, pairings):
+    """Create a table for each pairing with the organizer's account and send one summary embed.
+    Returns [(pairing, table url, error string)]."""
+    account, errs = await get_active_session(discord_id)
+    if errs:
+        await message.channel.send(errs)
+        return []
+    user_data = get_login(discord_id)
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def create_one(pairing):
+        async with semaphore:
+            try:
+                options = merge_options(user_data, pairing["game"], pairing["players"], dict(pairing["options"]))
+                table_url, invited_players, error_players, err = await create_table_for_players(
+                    message,
+                    account,
+                    pairing["game"],
+                    pairing["players"],
+                    discord_id,
+                    options,
+                    leave_tables=False,
+                )
+            except (BGAUnavailableError, BGARateLimitError) as e:
+                return pairing, "", str(e)
+            except Exception as e:  # One bad table shouldn't stop the others from being reported
+                logger.error(f"Unable to create bulk table {pairing}: {e}\n{traceback.format_exc()}")
+                return pairing, "", f"Unable to create this table ({e.__class__.__name__})."
+            if error_players:
+                err = "; ".join(error_players)
+            return pairing, table_url, err
+
+    status_msg = await message.channel.send(f"Creating {len(pairings)} tables...")
+    try:
+        # Leave the current table once, instead of before every table
+        await account.leave_current_tables()
+        results = await asyncio.gather(*[create_one(pairing) for pairing in pairings])
+    finally:
+        await status_msg.delete()
+    lines = []
+    num_created = 0
+    for pairing, table_url, err in results:
+        players = ", ".join(pairing["players"])
+        if table_url:
+            num_created += 1
+            line = f":white_check_mark: {pairing['game']} ({players}): {table_url}"
+            if err:
+                line += f" :x: {err}"
+        else:
+            line = f":x: {pairing['game']} ({players}): {err}"
+        lines.append(line)
+    logger.debug(f"Bulk created {num_created}/{len(pairings)} tables for {discord_id}")
+    await send_summary_embed(message, f"Created {num_created} of {len(pairings)} tables", lines)
+    return results
@@ -1,15 +1,34 @@
+import asyncio
+from collections import deque
+import json
 import logging.handlers
 import re
+import time
 
+from bga_account import compile_options
+from bga_health import BGAUnavailableError
+from bga_ratelimit import BGARateLimitError, PRIORITY_BACKGROUND, request_priority
+from creds_iface import get_prefs_version
 from creds_iface import get_discord_id
 from creds_iface import get_login
 from discord_utils import send_table_embed
-from creds_iface import get_active_session, get_all_logins
+from creds_iface import get_active_session
+from ttl_cache import TTLCache
 from utils import normalize_name
 
 logger = logging.getLogger(__name__)
 logging.getLogger("discord").setLevel(logging.WARN)
 
+# Max number of requests to send at the same time for one table (player lookups, options, invites)
+CREATE_CONCURRENCY = 4
+# Validated option requests (see get_option_plan)
+OPTION_PLAN_TTL = 86400
+MAX_OPTION_PLANS = 2000
+option_plans = TTLCache(OPTION_PLAN_TTL, max_entries=MAX_OPTION_PLANS)
+STAGE_SAMPLES = 200
+# Seconds from the start of create_bga_game to the end of each stage, for recent tables: {stage: deque}
+stage_latencies = {}
+
 
 async def setup_bga_game(message, p1_discord_id, game, players, options):
     """Setup a game on BGA based on the message.
@@ -19,20 +38,27 @@ async def setup_bga_game(message, p1_discord_id, game, players, options):
     if errs:
         return errs
     # Use user prefs set in !setup if set
-    logins = get_all_logins()
-    if (
-        str(message.author.id) in logins
-        and ("username" in logins[str(message.author.id)] and len(logins[str(message.author.id)]["username"]) > 0)
-        and ("password" in logins[str(message.author.id)] and len(logins[str(message.author.id)]["username"]) > 0)
+    user_data = get_login(message.author.id)
+    if not (
+        user_data
+        and ("username" in user_data and len(user_data["username"]) > 0)
+        and ("password" in user_data and len(user_data["username"]) > 0)
     ):
-        user_data = logins[str(message.author.id)]
-    else:
         return "Need BGA credentials to setup game. Run !setup."
+    merge_options(user_data, game, players, options)
+    table_msg = await message.channel.send("Creating table...")
+    await create_bga_game(message, account, game, players, p1_discord_id, options)
+    await table_msg.delete()
+    return ""
+
+
+def merge_options(user_data, game, players, options):
+    """Add the number of players and the user's saved preferences (from !setup) to options, in place."""
     user_prefs = {}
     all_game_prefs = {}
     # bga options and bga game options aren't necessarily defined
     if "bga options" in user_data:
-        user_prefs = user_data["bga options"]
+        user_prefs = dict(user_data["bga options"])
     if "bga game options" in user_data:
         all_game_prefs = user_data["bga game options"]
     if "players" not in options:  # play with exactly as many players as specified
@@ -43,46 +69,109 @@ async def setup_bga_game(message, p1_discord_id, game, players, options):
     if game_name in all_game_prefs:  # game prefs should override global prefs
         user_prefs.update(all_game_prefs[game_name])
     options.update(user_prefs)
-    table_msg = await message.channel.send("Creating table...")
-    await create_bga_game(message, account, game, players, p1_discord_id, options)
-    await table_msg.delete()
-    account.logout()  # Probably not necessary
-    account.close_connection()
-    return ""
+    return options
+
+
+async def prewarm_bga_game(discord_id):
+    """Log in to BGA ahead of setup_bga_game, at background priority so that it doesn't slow down other commands.
+    The logged in account stays in the session pool, where setup_bga_game will find it.
+    Run this in its own task: the priority only applies to the current task. Errors are left for setup_bga_game."""
+    request_priority.set(PRIORITY_BACKGROUND)
+    try:
+        _, errs = await get_active_session(discord_id)
+        if not errs:
+            logger.debug(f"Prewarmed BGA session for {discord_id}")
+    except (BGAUnavailableError, BGARateLimitError) as e:
+        logger.debug(f"Unable to prewarm BGA session for {discord_id}: {e!r}")
 
 
 async def create_bga_game(message, bga_account, game, players, p1_id, options):
     """Create the actual BGA game."""
+    table_url, invited_players, error_players, create_err = await create_table_for_players(
+        message,
+        bga_account,
+        game,
+        players,
+        p1_id,
+        options,
+    )
+    if create_err:
+        await message.channel.send(create_err)
+        return
+    author_bga = get_login(p1_id)["username"]
+    author_str = f"\n:crown: <@!{p1_id}> (BGA {author_bga})"
+    invited_players_str = "".join(["\n:white_check_mark: " + p for p in invited_players])
+    error_players_str = "".join(["\n:x: " + p for p in error_players])
+    await send_table_embed(
+        message,
+        game,
+        table_url,
+        author_str,
+        invited_players_str,
+        "Failed to Invite",
+        error_players_str,
+    )
+
+
+async def create_table_for_players(message, bga_account, game, players, p1_id, options, leave_tables=True):
+    """Create a table, set its options and invite the players.
+    Steps that don't depend on each other run at the same time: player ids are looked up while
+    leaving the current table, and options and invites are sent together once the table exists.
+    Use leave_tables=False when creating many tables at once (the current table is left only once).
+    Returns (table url, [invited player], [player error], error string (str))"""
+    stages = {}
+    start = time.monotonic()
     # If the player is a discord tag, this will be
     # {"bga player": "discord tag"}, otherwise {"bga player":""}
     error_players = []
     bga_discord_user_map = await find_bga_users(players, error_players)
     bga_players = list(bga_discord_user_map.keys())
-    table_id, create_err = bga_account.create_table(game)
-    if len(create_err) > 0:
-        await message.channel.send(create_err)
-        return
-    valid_bga_players = []
-    invited_players = []
-    err_msg = bga_account.set_table_options(options, table_id)
-    if err_msg:
-        await message.channel.send(err_msg)
-        return
-    table_url = bga_account.create_table_url(table_id)
     author_bga = get_login(p1_id)["username"]
     # Don't invite the creator to their own game!
     if author_bga in bga_players:
         bga_players.remove(author_bga)
-    for bga_player in bga_players:
-        bga_player_id = bga_account.get_player_id(bga_player)
+    game_id, create_err = bga_account.resolve_game_id(game)
+    if len(create_err) > 0:
+        return "", [], [], create_err
+    # Check the options before anything is sent so that nobody is invited to a table with bad options
+    option_plan = get_option_plan(p1_id, game, options)
+    if isinstance(option_plan, str):  # In this case it's an error
+        return "", [], [], option_plan
+    semaphore = asyncio.Semaphore(CREATE_CONCURRENCY)
+    player_ids_task = asyncio.ensure_future(get_player_ids(bga_account, bga_players, semaphore))
+    try:
+        if leave_tables:
+            await bga_account.leave_current_tables()
+            stages["leave tables"] = time.monotonic() - start
+        table_id, create_err = await bga_account.create_table_with_id(game_id)
+        stages["create table"] = time.monotonic() - start
+        if len(create_err) > 0:
+            return "", [], [], create_err
+        url_data = await bga_account.resolve_option_plan(option_plan, table_id)
+        if isinstance(url_data, str):  # In this case it's an error
+            return "", [], [], url_data
+        bga_player_ids = await player_ids_task
+        stages["find players"] = time.monotonic() - start
+        _, invite_errors = await asyncio.gather(
+            bga_account.set_options(table_id, url_data, semaphore),
+            asyncio.gather(
+                *[invite_player(bga_account, table_id, player_id, semaphore) for player_id in bga_player_ids],
+            ),
+        )
+        stages["options and invites"] = time.monotonic() - start
+    finally:
+        player_ids_task.cancel()
+    record_stages(stages)
+    table_url = bga_account.create_table_url(table_id)
+    valid_bga_players = []
+    invited_players = []
+    for bga_player, bga_player_id, error in zip(bga_players, bga_player_ids, invite_errors):
         if bga_player_id == -1:
             error_players.append(f"`{bga_player}` is not a BGA player")
+        elif len(error) > 0:  # If there's error text
+            error_players.append(f"Unable to add `{bga_player}` because {error}")
         else:
-            error = bga_account.invite_player(table_id, bga_player_id)
-            if len(error) > 0:  # If there's error text
-                error_players.append(f"Unable to add `{bga_player}` because {error}")
-            else:
-                valid_bga_players.append(bga_player)
+            valid_bga_players.append(bga_player)
     for bga_name in valid_bga_players:
         discord_tag = bga_discord_user_map[bga_name]
         if len(discord_tag) > 0:  # If the player was passed in as a discord tag
@@ -96,18 +185,43 @@ async def create_bga_game(message, bga_account, game, players, p1_id, options):
                 invited_players.append(
                     f"(BGA {bga_name}) needs to run `!setup` to add BGA settings",
                 )
-    author_str = f"\n:crown: <@!{p1_id}> (BGA {author_bga})"
-    invited_players_str = "".join(["\n:white_check_mark: " + p for p in invited_players])
-    error_players_str = "".join(["\n:x: " + p for p in error_players])
-    await send_table_embed(
-        message,
-        game,
-        table_url,
-        author_str,
-        invited_players_str,
-        "Failed to Invite",
-        error_players_str,
-    )
+    return table_url, invited_players, error_players, ""
+
+
+def get_option_plan(discord_id, game, options):
+    """Get the validated option requests for these options, compiling them only the first time.
+    Plans are kept per user, game and version of the user's preferences, so saving new preferences replaces them."""
+    key = (str(discord_id), normalize_name(game), get_prefs_version(discord_id), json.dumps(options, sort_keys=True))
+    option_plan = option_plans.get(key)
+    if option_plan is None:
+        option_plan = compile_options(options)
+        option_plans.set(key, option_plan)
+    return option_plan
+
+
+async def get_player_ids(bga_account, bga_players, semaphore):
+    """Get the BGA ids of players at the same time. Missing players are -1."""
+
+    async def get_player_id_bounded(bga_player):
+        async with semaphore:
+            return await bga_account.get_player_id(bga_player)
+
+    return await asyncio.gather(*[get_player_id_bounded(bga_player) for bga_player in bga_players])
+
+
+async def invite_player(bga_account, table_id, bga_player_id, semaphore):
+    """Invite a player if they exist. Returns error text or ""."""
+    if bga_player_id == -1:
+        return ""
+    async with semaphore:
+        return await bga_account.invite_player(table_id, bga_player_id)
+
+
+def record_stages(stages):
+    """Keep the time it took to reach the end of each step of creating a table and log it."""
+    for stage, seconds in stages.items():
+        stage_latencies.setdefault(stage, deque(maxlen=STAGE_SAMPLES)).append(seconds)
+    logger.debug("Created table in " + ", ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in stages.items()))
 
 
 async def find_bga_users(players, error_players):
@@ -1,13 +1,20 @@
 """Get/cache available games. Cache is bga_game_list.json."""
+import asyncio
+import bisect
 import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import random
 import re
 import time
+import traceback
 
-import requests
+import aiohttp
 
+from bga_ratelimit import request_scheduler, PRIORITY_BACKGROUND
+from offload import run_blocking
+from singleflight import SingleFlight
 from utils import normalize_name
 
 logging.getLogger("aiohttp").setLevel(logging.WARN)
@@ -22,41 +29,235 @@ logger.setLevel(logging.DEBUG)
 
 
 GAME_LIST_PATH = "src/bga_game_list.json"
+# Refresh the cached game list every 6 hours in the background
+REFRESH_INTERVAL = 21600
+REFRESH_JITTER = 600
+REFRESH_RETRY_DELAY = 60
+REFRESH_TIMEOUT = 60
+# BGA uses different names *in game* than for game creation, so recognize this.
+GAME_ALIASES = {
+    "redsevengame": "red7",
+    "sechsnimmt": "6nimmt",
+    "sevenwonders": "7wonders",
+    "sevenwondersduel": "7wondersduel",
+    "yatzy": "yahtzee",  # `yatzy` is due to it initially using the French name due to copyright concerns
+    "arnak": "lostruinsofarnak",
+}
+
+
+class GameIndex:
+    """Lookups over the game list. Names are compared with normalize_name.
+    New games are added in place; a new index replaces this one when the whole list is refreshed."""
+
+    def __init__(self, games):
+        self.games = {}  # {"Game name": game id}
+        self.names = {}  # {"normalizedname": "Game name"}, including aliases
+        self.ids = {}  # {"game id": "Game name"}
+        self.sorted_names = []  # Normalized names without aliases, for prefix search
+        for game_name, game_id in games.items():
+            self.games[game_name] = game_id
+            self.names[normalize_name(game_name)] = game_name
+            # Keep the first name of an id, which is the display name. Slugs from table pages come later.
+            self.ids.setdefault(str(game_id), game_name)
+        self.sorted_names = sorted(self.names)
+        for alias in GAME_ALIASES:
+            self.add_alias(alias)
+
+    def add_alias(self, alias):
+        target = GAME_ALIASES[alias]
+        if target in self.names and alias not in self.names:
+            self.names[alias] = self.names[target]
+
+    def add_game(self, game_name, game_id):
+        """Add a game that wasn't in the list without rebuilding the index."""
+        normalized_name = normalize_name(game_name)
+        self.games[game_name] = game_id
+        self.ids.setdefault(str(game_id), game_name)
+        if normalized_name not in self.names:
+            bisect.insort(self.sorted_names, normalized_name)
+        self.names[normalized_name] = game_name
+        for alias in GAME_ALIASES:
+            if GAME_ALIASES[alias] == normalized_name:
+                self.add_alias(alias)
+
+    def is_valid(self, game_name):
+        return normalize_name(game_name) in self.names
+
+    def canonical_name(self, game_name):
+        """Get the normalized name used for game creation, which may differ from the in-game name."""
+        normalized_name = normalize_name(game_name)
+        return GAME_ALIASES.get(normalized_name, normalized_name)
+
+    def get_id(self, game_name):
+        """Get the id of a game by exact (normalized) name or -1."""
+        normalized_name = normalize_name(game_name)
+        if normalized_name not in self.names:
+            return -1
+        return self.games[self.names[normalized_name]]
+
+    def find_prefix(self, game_name_part):
+        """Get the normalized names of all games that start with this partial name, like race for raceforthegalaxy."""
+        prefix = normalize_name(game_name_part)
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names, prefix + "\uffff")
+        return self.sorted_names[start:end]
+
+    def get_name(self, game_id):
+        """Get the game name for a game id or an empty string."""
+        return self.ids.get(str(game_id), "")
+
+
+game_index = None
+cache_file_lock = asyncio.Lock()
+
+
+def get_game_index():
+    """Get the current game index, loading the game list if necessary."""
+    if game_index is None:
+        get_game_list()
+    return game_index
+
+
+def set_game_index(games):
+    """Replace the current index in one assignment so that readers never see a partial index."""
+    global game_index
+    game_index = GameIndex(games)
+    return game_index
 
 
 def get_game_list_from_cache():
+    if game_index is not None:
+        return game_index.games, ""
     with open(GAME_LIST_PATH, "r") as f:
-        logger.debug("Loading game list from cache because the game list has been checked in the last week.")
-        return json.loads(f.read()), ""
+        logger.debug("Loading game list from cache.")
+        games = json.loads(f.read())
+    if not game_list_refresher.last_success:
+        game_list_refresher.last_success = os.path.getmtime(GAME_LIST_PATH)
+    return set_game_index(games).games, ""
 
 
 def get_game_list():
     """Get the list of games and numbers BGA assigns to each game.
+    This always returns the cached list right away. If it's out of date, it's refreshed in the background.
+    """
+    games, err_msg = get_game_list_from_cache()
+    if game_list_refresher.is_stale():
+        game_list_refresher.request_refresh()
+    return games, err_msg
+
+
+async def download_game_list():
+    """Download and parse the game list from BGA.
     The url below should be accessible unauthenticated (test with curl).
     """
-    sixhours = 21600
-    if time.time() - sixhours < os.path.getmtime(GAME_LIST_PATH):
-        return get_game_list_from_cache()
     url = "https://boardgamearena.com/gamelist?section=all"
-    with requests.Session() as session:
-        with session.get(url) as response:
-            if response.status_code >= 400:
-                # If there's a problem with getting the most accurate list, use cached version
-                with open(GAME_LIST_PATH, "r") as f:
-                    logger.debug("Loading game list from cache because BGA was unavailable")
-                    return json.loads(f.read()), ""
-            html = response.text
-            # Parse an HTML list
-            results = re.findall(r"item_tag_\d+_(\d+)[\s\S]*?name\">\s+([^<>]*)\n", html)
-            # Sorting games so when writing, git picks up on new entries
-            results.sort(key=lambda x: x[1])
-            games = {}
-            for r in results:
-                games[r[1]] = int(r[0])
-            # We need to read AND update the existing json because the BGA game list doesn't
-            # include "games in review" that may be saved in the json.
-            update_games_cache(games)
-            return games, ""
+    timeout = aiohttp.ClientTimeout(total=REFRESH_TIMEOUT)
+    await request_scheduler.acquire("gamelist", PRIORITY_BACKGROUND)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as response:
+            if response.status >= 400:
+                raise IOError(f"BGA returned HTTP {response.status} for the game list")
+            html = await response.text()
+    return await run_blocking("parse game list", parse_game_list, html)
+
+
+def parse_game_list(html):
+    # Parse an HTML list
+    results = re.findall(r"item_tag_\d+_(\d+)[\s\S]*?name\">\s+([^<>]*)\n", html)
+    # Sorting games so when writing, git picks up on new entries
+    results.sort(key=lambda x: x[1])
+    games = {}
+    for r in results:
+        games[r[1]] = int(r[0])
+    return games
+
+
+class GameListRefresher:
+    """Refresh the game list in the background so that commands never wait for BGA."""
+
+    def __init__(self):
+        self.last_success = 0
+        self.last_failure = 0
+        self.last_error = ""
+        self.failures = 0
+        self.flight = SingleFlight()
+        self.task = None
+
+    def cache_age(self):
+        return time.time() - self.last_success
+
+    def is_stale(self):
+        return self.cache_age() > REFRESH_INTERVAL
+
+    def status(self):
+        return {
+            "cache age": int(self.cache_age()),
+            "last success": self.last_success,
+            "last failure": self.last_failure,
+            "last error": self.last_error,
+            "consecutive failures": self.failures,
+        }
+
+    def record_failure(self, error):
+        self.failures += 1
+        self.last_failure = time.time()
+        self.last_error = str(error) or error.__class__.__name__
+
+    def start(self):
+        """Start refreshing on a schedule. Call from the event loop."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.next_delay())
+            try:
+                await self.refresh()
+            except Exception as e:  # Like a bad cache file. Keep refreshing instead of ending the task.
+                self.record_failure(e)
+                logger.error(f"Unable to refresh game list: {e!r}\n{traceback.format_exc()}")
+
+    def next_delay(self):
+        """Seconds until the next refresh, with jitter, backing off while BGA is failing."""
+        if self.failures > 0:
+            backoff = min(REFRESH_RETRY_DELAY * 2 ** (self.failures - 1), REFRESH_INTERVAL)
+            return backoff + random.uniform(0, backoff / 2)
+        return max(0, REFRESH_INTERVAL - self.cache_age()) + random.uniform(0, REFRESH_JITTER)
+
+    def request_refresh(self):
+        """Refresh now in the background if the scheduled refresher isn't running (it would do it anyway)."""
+        if self.task is not None and not self.task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Not running in the bot, so keep using the cached list
+        asyncio.ensure_future(self.refresh())
+
+    async def refresh(self):
+        """Refresh the game list. Concurrent calls share the same download.
+        Returns whether the refresh succeeded."""
+        return await self.flight.do("gamelist", self.refresh_once)
+
+    async def refresh_once(self):
+        try:
+            games = await download_game_list()
+            if len(games) == 0:
+                raise IOError("No games found in the BGA game list page")
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            self.record_failure(e)
+            logger.error(f"Unable to refresh game list, keeping cached version: {self.status()}")
+            return False
+        # We need to read AND update the existing json because the BGA game list doesn't
+        # include "games in review" that may be saved in the json.
+        await update_games_cache(games, rebuild_index=True)
+        self.failures = 0
+        self.last_success = time.time()
+        logger.debug(f"Refreshed game list with {len(games)} games")
+        return True
+
+
+game_list_refresher = GameListRefresher()
 
 
 def bga_game_message_list():
@@ -79,20 +280,30 @@ def bga_game_message_list():
     return retlist
 
 
-def update_games_cache(games):
+async def update_games_cache(games, rebuild_index=False):
+    """Merge games into the cache file. New games are added to the index incrementally
+    unless this is a full refresh of the list."""
+    async with cache_file_lock:
+        games, new_games = await run_blocking("write game list", write_games_cache, games)
+    if rebuild_index or game_index is None:
+        set_game_index(games)
+    else:
+        for game_name, game_id in new_games.items():
+            game_index.add_game(game_name, game_id)
+
+
+def write_games_cache(games):
+    """Merge games with the cache file and write it. Returns (all games, games that weren't in the file)."""
     with open(GAME_LIST_PATH, "r") as f:
         file_text = f.read()
         file_games = json.loads(file_text)
+        new_games = {game: games[game] for game in games if game not in file_games}
         games.update(file_games)
     with open(GAME_LIST_PATH, "w") as f:
         f.write(json.dumps(games, indent=2) + "\n")
+    return games, new_games
 
 
 async def is_game_valid(game):
     # Check if any words are games
-    games, errs = get_game_list()
-    if errs:
-        games, errs = get_game_list_from_cache()
-    normalized_games = [normalize_name(g) for g in games]
-    normalized_game = normalize_name(game)
-    return normalized_game in normalized_games
+    return get_game_index().is_valid(game)
@@ -0,0 +1,172 @@
+"""Keep track of how BGA is responding so that the bot doesn't hang or pile up commands when BGA is slow or down.
+
+Timeouts for each endpoint come from how long that endpoint has recently taken. Reads that are slower
+than usual are hedged (sent again, using whichever answer comes first). After too many failures in a row,
+the circuit breaker opens: requests fail right away until a background probe sees that BGA is back.
+"""
+import asyncio
+from collections import deque
+import logging
+from logging.handlers import RotatingFileHandler
+import re
+import urllib.parse
+
+import aiohttp
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Timeouts in seconds. Until an endpoint has MIN_SAMPLES latencies, DEFAULT_TIMEOUT is used and reads aren't hedged.
+DEFAULT_TIMEOUT = 20
+MIN_TIMEOUT = 5
+MAX_TIMEOUT = 30
+TIMEOUT_MULTIPLIER = 3  # timeout = p99 * this
+HEDGE_PERCENTILE = 0.95
+MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+MAX_ENDPOINTS = 200
+FAILURE_THRESHOLD = 5
+PROBE_URL = "https://boardgamearena.com"
+PROBE_INTERVAL = 15
+PROBE_TIMEOUT = 10
+# Game pages are served by many game servers, so one unhealthy game server doesn't mean that BGA is down
+GAME_PAGE_ENDPOINT = "/<gameserver>/<game>"
+UNAVAILABLE_MSG = "Board Game Arena isn't responding right now. Try again in a few minutes."
+
+
+class BGAUnavailableError(Exception):
+    """BGA didn't answer, or is known to be down."""
+
+
+def get_endpoint(url):
+    """Group urls by path. Game pages (like /1/carcassonne?table=123) are all grouped together."""
+    path = urllib.parse.urlsplit(url).path
+    if re.match(r"^/\d+/", path):
+        return GAME_PAGE_ENDPOINT
+    return path
+
+
+class LatencyTracker:
+    """Recent latencies of each endpoint, used to pick timeouts and when to hedge."""
+
+    def __init__(self):
+        self.samples = {}  # {endpoint: deque of seconds}
+        self.hedged = 0
+
+    def record(self, endpoint, seconds):
+        if endpoint not in self.samples and len(self.samples) >= MAX_ENDPOINTS:
+            endpoint = "other"
+        self.samples.setdefault(endpoint, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+    def percentile(self, endpoint, fraction):
+        """Get the latency percentile of this endpoint, or None if there aren't enough samples yet."""
+        samples = self.samples.get(endpoint, ())
+        if len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(fraction * (len(ordered) - 1))]
+
+    def timeout(self, endpoint):
+        p99 = self.percentile(endpoint, 0.99)
+        if p99 is None:
+            return DEFAULT_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, p99 * TIMEOUT_MULTIPLIER))
+
+    def hedge_delay(self, endpoint):
+        return self.percentile(endpoint, HEDGE_PERCENTILE)
+
+    def stats(self):
+        return {
+            endpoint: {"p50": self.percentile(endpoint, 0.5), "p95": self.percentile(endpoint, 0.95)}
+            for endpoint in self.samples
+        }
+
+
+async def hedge(make_request, delay, make_hedge=None, can_hedge=None):
+    """Await make_request(). If it hasn't finished after delay seconds, start make_hedge() (by default, make_request()
+    again) and return whichever succeeds first. No second request is sent if can_hedge() is false at that point.
+    Only use this for requests that are safe to send twice."""
+    tasks = [asyncio.ensure_future(make_request())]
+    if delay is None:
+        return await tasks[0]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and (can_hedge is None or can_hedge()):
+            bga_latency.hedged += 1
+            tasks.append(asyncio.ensure_future((make_hedge or make_request)()))
+        while True:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            tasks = [task for task in tasks if not task.done()]
+            if not tasks:  # Every request failed
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class CircuitBreaker:
+    """Fail fast while BGA is down instead of letting every command wait for its own timeout."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD):
+        self.failure_threshold = failure_threshold
+        self.failures = 0  # Requests in a row that failed after all of their retries
+        self.is_open = False
+        self.probe_task = None
+
+    def check(self):
+        """Raise BGAUnavailableError if BGA is known to be down."""
+        if self.is_open:
+            raise BGAUnavailableError(UNAVAILABLE_MSG)
+
+    def counts(self, endpoint):
+        """Whether requests to this endpoint tell if BGA is up."""
+        return endpoint != GAME_PAGE_ENDPOINT
+
+    def record_success(self):
+        self.failures = 0
+        if self.is_open:
+            self.close()
+
+    def record_failure(self):
+        self.failures += 1
+        if not self.is_open and self.failures >= self.failure_threshold:
+            logger.warning(f"Opening the BGA circuit breaker after {self.failures} failures in a row.")
+            self.is_open = True
+            if self.probe_task is None or self.probe_task.done():
+                self.probe_task = asyncio.ensure_future(self.probe_until_up())
+
+    def close(self):
+        logger.info("BGA is responding again. Closing the circuit breaker.")
+        self.is_open = False
+        self.failures = 0
+
+    async def probe_until_up(self):
+        while self.is_open:
+            await asyncio.sleep(PROBE_INTERVAL)
+            if await self.probe():
+                self.close()
+
+    async def probe(self):
+        timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(PROBE_URL) as response:
+                    return response.status < 500
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.debug(f"BGA probe failed: {e!r}")
+            return False
+
+    def stats(self):
+        return {"open": self.is_open, "failures in a row": self.failures}
+
+
+bga_latency = LatencyTracker()
+bga_circuit = CircuitBreaker()
@@ -8,6 +8,4 @@ async def send_message(author_discord_id, dest_player_name, message_content):
     if errs:
         return errs
     success_msg = await account.message_player(dest_player_name, message_content)
-    await account.logout()  # Probably not necessary
-    await account.close_connection()
     return success_msg
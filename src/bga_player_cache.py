@@ -0,0 +1,79 @@
+"""Cache BGA player name -> player id lookups. Cache is bga_player_cache.json.
+
+Names are case-insensitive. Players that BGA doesn't know about are cached as -1 for a short time
+so that typos don't cause repeated searches, but new accounts are still found soon after.
+"""
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import time
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+PLAYER_CACHE_PATH = "src/bga_player_cache.json"
+FOUND_TTL = 30 * 86400
+NOT_FOUND_TTL = 600
+# Write the cache to disk at most this often (seconds)
+SAVE_INTERVAL = 60
+
+
+class PlayerIdCache:
+    """Case-insensitive BGA player name -> player id with per-entry expiry."""
+
+    def __init__(self, path=PLAYER_CACHE_PATH):
+        self.path = path
+        self.entries = {}  # {"lowercase name": [player_id, expiry timestamp]}
+        self.last_save = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            logger.error(f"Unable to read player cache {self.path}: {e}")
+            self.entries = {}
+
+    def save(self):
+        now = time.time()
+        self.entries = {name: entry for name, entry in self.entries.items() if entry[1] > now}
+        self.last_save = now
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(self.entries))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Unable to write player cache {self.path}: {e}")
+
+    def get(self, player_name):
+        """Get the player id, -1 if the player is known not to exist, or None if it's not cached."""
+        entry = self.entries.get(player_name.lower())
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def set(self, player_name, player_id):
+        ttl = NOT_FOUND_TTL if player_id == -1 else FOUND_TTL
+        self.entries[player_name.lower()] = [player_id, time.time() + ttl]
+        if time.time() - self.last_save > SAVE_INTERVAL:
+            self.save()
+
+    def seed(self, name_id_pairs):
+        """Add players whose ids we already know, like the ones saved with !setup."""
+        for player_name, player_id in name_id_pairs:
+            if player_name and player_id not in ["", None, -1]:
+                self.entries[player_name.lower()] = [player_id, time.time() + FOUND_TTL]
+        self.save()
+
+
+player_id_cache = PlayerIdCache()
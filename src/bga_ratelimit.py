@@ -0,0 +1,127 @@
+"""Limit how fast the bot sends requests to BGA so that it doesn't get throttled.
+
+Every request takes a token from a global bucket and from the bucket of the BGA account making it.
+Interactive requests (like creating a table for !play) go before background requests.
+What happens when requests have waited too long is set by SATURATION_POLICY.
+"""
+import asyncio
+from collections import deque
+import contextvars
+import heapq
+import itertools
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Requests per second and burst size
+GLOBAL_RATE = 20
+GLOBAL_BURST = 40
+ACCOUNT_RATE = 4
+ACCOUNT_BURST = 10
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+# "wait": always wait for a token. "reject": raise BGARateLimitError once a request has waited MAX_WAIT seconds.
+SATURATION_POLICY = "wait"
+MAX_WAIT = 30
+# How often a request that is behind higher priority requests checks again
+PRIORITY_POLL_INTERVAL = 0.05
+MAX_ACCOUNT_BUCKETS = 5000
+WAIT_SAMPLES = 500
+
+
+# Priority of the requests made by the current task. Background work (like prewarming a session) sets this to
+# PRIORITY_BACKGROUND in its own task, so it doesn't change the priority of commands using the same account.
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+
+class BGARateLimitError(Exception):
+    """Too many requests are waiting to be sent to BGA."""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_token(self):
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class RequestScheduler:
+    """Hand out permission to send requests, within the global and per-account rates and in priority order."""
+
+    def __init__(self, policy=SATURATION_POLICY):
+        self.policy = policy
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.account_buckets = {}
+        self.waiting = []  # heap of [priority, sequence number]
+        self.sequence = itertools.count()
+        self.waits = {PRIORITY_INTERACTIVE: deque(maxlen=WAIT_SAMPLES), PRIORITY_BACKGROUND: deque(maxlen=WAIT_SAMPLES)}
+
+    def get_account_bucket(self, account_key):
+        if account_key not in self.account_buckets:
+            if len(self.account_buckets) >= MAX_ACCOUNT_BUCKETS:
+                # A full bucket is the same as a new one, so those can be dropped
+                self.account_buckets = {k: b for k, b in self.account_buckets.items() if not b.is_full()}
+            self.account_buckets[account_key] = TokenBucket(ACCOUNT_RATE, ACCOUNT_BURST)
+        return self.account_buckets[account_key]
+
+    async def acquire(self, account_key, priority=PRIORITY_INTERACTIVE):
+        """Wait until this account may send a request."""
+        start = time.monotonic()
+        entry = [priority, next(self.sequence)]
+        heapq.heappush(self.waiting, entry)
+        try:
+            while True:
+                account_bucket = self.get_account_bucket(account_key)
+                if self.waiting[0][0] < priority:  # Higher priority requests go first
+                    delay = PRIORITY_POLL_INTERVAL
+                else:
+                    delay = max(self.global_bucket.time_until_token(), account_bucket.time_until_token())
+                    if delay == 0:
+                        self.global_bucket.tokens -= 1
+                        account_bucket.tokens -= 1
+                        break
+                if self.policy == "reject" and time.monotonic() - start + delay > MAX_WAIT:
+                    logger.info(f"Rejected BGA request for {account_key}: {self.stats()}")
+                    raise BGARateLimitError(f"Waited more than {MAX_WAIT}s to send a request to BGA")
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+        self.waits[priority].append(time.monotonic() - start)
+
+    def is_saturated(self):
+        """Whether requests are waiting for a token, so optional requests (like hedges) shouldn't be sent."""
+        return len(self.waiting) > 0
+
+    def stats(self):
+        stats = {"waiting": len(self.waiting)}
+        for priority, name in [(PRIORITY_INTERACTIVE, "interactive"), (PRIORITY_BACKGROUND, "background")]:
+            waits = list(self.waits[priority])
+            stats[name + " avg wait"] = sum(waits) / len(waits) if waits else 0
+            stats[name + " max wait"] = max(waits) if waits else 0
+        return stats
+
+
+request_scheduler = RequestScheduler()
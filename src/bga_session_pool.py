@@ -0,0 +1,141 @@
+"""Keep logged-in BGA sessions around so that every command doesn't have to log in again.
+
+Sessions are keyed by discord id. Idle sessions expire after IDLE_TTL seconds and the least
+recently used session is evicted once there are more than MAX_SESSIONS.
+"""
+import asyncio
+from collections import OrderedDict
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+
+from bga_account import BGAAccount
+from bga_ratelimit import request_priority
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+MAX_SESSIONS = 200
+IDLE_TTL = 1800
+# Evicted sessions may still be used by a running command, so close them a little later.
+CLOSE_GRACE_PERIOD = 60
+
+
+class PooledSession:
+    """A logged-in account and the credentials used for it."""
+
+    def __init__(self, account, username, password):
+        self.account = account
+        self.username = username
+        self.password = password
+        self.last_used = time.time()
+        self.login_task = None  # Login in progress, shared by every command that needs it
+        self.login_priority = None
+
+
+class BGASessionPool:
+    """LRU pool of logged-in BGA accounts with an idle TTL."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_ttl=IDLE_TTL):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+
+    async def get(self, discord_id, username, password, saved_cookies=None):
+        """Get a logged-in account for this user, logging in only if there isn't a usable one.
+        A new session uses saved_cookies (from BGAAccount.export_cookies) if there are any instead of logging in.
+        Returns the account or None if BGA rejected the username/password."""
+        discord_id = str(discord_id)
+        self.evict_expired()
+        pooled = self.sessions.get(discord_id)
+        if pooled is None or pooled.username != username or pooled.password != password:
+            if pooled is not None:
+                self.discard(discord_id)
+            pooled = PooledSession(BGAAccount(), username, password)
+            if saved_cookies:
+                logger.debug(f"Restoring saved BGA cookies for discord id {discord_id}")
+                pooled.account.restore_session(username, password, saved_cookies)
+            self.sessions[discord_id] = pooled
+        self.sessions.move_to_end(discord_id)
+        pooled.last_used = time.time()
+        while not pooled.account.logged_in:
+            login = self.start_login(discord_id, pooled)
+            await asyncio.wait([login])
+            if login.cancelled():  # A higher priority command took over the login
+                continue
+            if not login.result():
+                self.discard(discord_id)
+                return None
+        self.evict_overflow()
+        return pooled.account
+
+    def start_login(self, discord_id, pooled):
+        """Get the login in progress, so the same user only logs in once when sending commands at the same time.
+        A login at a lower priority than the current task (like a prewarm) is restarted at this task's priority,
+        so that a command doesn't wait behind background requests. Returns the login task."""
+        priority = request_priority.get()
+        login = pooled.login_task
+        if login is not None and not login.done() and pooled.login_priority > priority:
+            logger.debug(f"Taking over the BGA login for discord id {discord_id} at priority {priority}")
+            login.cancel()
+        elif login is not None and not login.done():
+            return login
+        logger.debug(f"Logging in to BGA for discord id {discord_id}")
+        pooled.login_task = asyncio.ensure_future(pooled.account.login(pooled.username, pooled.password))
+        pooled.login_priority = priority
+        return pooled.login_task
+
+    def put(self, discord_id, account):
+        """Add an account that has already been logged in."""
+        discord_id = str(discord_id)
+        if discord_id in self.sessions:
+            self.discard(discord_id)
+        self.sessions[discord_id] = PooledSession(account, account.username, account.password)
+        self.evict_overflow()
+
+    def discard(self, discord_id):
+        """Remove a user's session, i.e. if they purge their data."""
+        pooled = self.sessions.pop(str(discord_id), None)
+        if pooled is not None:
+            close_later(pooled.account)
+
+    def evict_expired(self):
+        cutoff = time.time() - self.idle_ttl
+        # Sessions are in LRU order, so stop at the first one that is still fresh
+        while self.sessions:
+            discord_id, pooled = next(iter(self.sessions.items()))
+            if pooled.last_used > cutoff:
+                break
+            logger.debug(f"Evicting idle BGA session for discord id {discord_id}")
+            self.discard(discord_id)
+
+    def evict_overflow(self):
+        while len(self.sessions) > self.max_sessions:
+            discord_id = next(iter(self.sessions))
+            logger.debug(f"Evicting least recently used BGA session for discord id {discord_id}")
+            self.discard(discord_id)
+
+    async def close_all(self):
+        """Close every session on shutdown."""
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for pooled in sessions:
+            await pooled.account.close_connection()
+
+
+def close_later(account):
+    """Close the account's connection once commands that might be using it have finished."""
+
+    async def close():
+        await asyncio.sleep(CLOSE_GRACE_PERIOD)
+        await account.close_connection()
+
+    asyncio.ensure_future(close())
+
+
+session_pool = BGASessionPool()
@@ -1,13 +1,14 @@
 """Functions to check the status of an existing game on BGA."""
+import asyncio
 import datetime
 import logging
 from logging.handlers import RotatingFileHandler
 
-from bga_account import BGAAccount
+from bga_account import BGAAccount, tables_cache, table_metadata_cache
 from bga_game_list import get_game_list
+from bga_game_list import get_game_index
 from bga_game_list import update_games_cache
 from creds_iface import get_discord_id
-from utils import normalize_name
 
 logging.getLogger("discord").setLevel(logging.WARN)
 
@@ -19,64 +20,62 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+# Max number of table pages to download at the same time for one !status
+TABLE_METADATA_CONCURRENCY = 8
 
-async def get_tables_by_players(players, message, send_running_tables=True, game_target=""):
-    """Send running tables option is for integration where people don't want to see existing tables."""
-    bga_ids = []
-    tables = {}
-    bga_account = BGAAccount()
-    sent_messages = []
+
+async def get_tables_by_players(players, message, send_running_tables=True, game_target="", fresh=False):
+    """Send running tables option is for integration where people don't want to see existing tables.
+    Use fresh to skip cached table data."""
     for player in players:
         if player.startswith("<@"):
             await message.channel.send("Not yet set up to read discord tags.")
-            bga_account.close_connection()
             return
-        bga_id = bga_account.get_player_id(player)
+    bga_account = BGAAccount()
+    sent_messages = []
+    bga_ids = await asyncio.gather(*[bga_account.get_player_id(player) for player in players])
+    for player, bga_id in zip(players, bga_ids):
         if bga_id == -1:
             await message.channel.send(f"Player {player} is not a valid bga name.")
-            bga_account.close_connection()
+            await bga_account.close_connection()
             return
-        bga_ids.append(bga_id)
-        player_tables = bga_account.get_tables(bga_id)
-        found_msg = await message.channel.send(f"Found {str(len(player_tables))} tables for {player}")
-        sent_messages += [found_msg]
-        tables.update(player_tables)
+    # A table with all of the players is in every player's table list, so one listing is enough.
+    # The tables of the other players are filtered out locally below.
+    tables = await bga_account.get_tables(bga_ids[0], fresh=fresh)
+    found_msg = await message.channel.send(f"Found {str(len(tables))} tables for {players[0]}")
+    sent_messages += [found_msg]
 
-    bga_games, err_msg = get_game_list()
+    _, err_msg = get_game_list()
     if len(err_msg) > 0:
         await message.channel.send(err_msg)
+        await bga_account.close_connection()
         return
-    normalized_bga_games = [normalize_name(game) for game in bga_games]
+    game_index = get_game_index()
+    target_name = game_index.canonical_name(game_target)
     player_tables = []
-    for table_id in tables:
-        table = tables[table_id]
+    for table in tables.values():
         table_player_ids = table["player_display"]  # Table.player_display is the player Ids at this table
         if set(bga_ids).issubset(table_player_ids):
             # match the game if a game was specified
-            normalized_game_name = get_bga_alias(table["game_name"])
-            if len(game_target) == 0 or normalized_game_name == normalize_name(game_target):
+            if len(game_target) == 0 or game_index.canonical_name(table["game_name"]) == target_name:
                 player_tables.append(table)
-    for table in player_tables:
+    if send_running_tables and len(player_tables) > 0:
         sent_messages += [await message.channel.send("Getting table information...")]
-        logger.debug(f"Checking table {table_id} for bga_ids {str(bga_ids)} in table {str(table)}")
+    tables_to_send = []
+    for table in player_tables:
+        logger.debug(f"Checking table {table['id']} for bga_ids {str(bga_ids)} in table {str(table)}")
         # Check for game name by id as it may differ from name (i.e. 7 vs 'seven')
-        game_name_list = [game for game in bga_games if table["game_id"] == str(bga_games[game])]
-        if len(game_name_list) == 0:
+        game_name = game_index.get_name(table["game_id"])
+        if not game_name:
             game_name = table["game_name"]
-            new_game = {table["game_name"]: table["game_id"]}
-            normalized_bga_games.append(normalize_name(table["game_name"]))
-            update_games_cache(new_game)
-        else:
-            game_name = game_name_list[0]
-        if normalize_name(game_name) not in normalized_bga_games:
-            bga_account.close_connection()
-            await message.channel.send(f"{game_name} is not a BGA game.")
-            return
+            await update_games_cache({game_name: table["game_id"]})
         # Only add table status lines for games we care about
-        if len(game_target) > 0 and normalize_name(game_name) != normalize_name(game_target):
+        if len(game_target) > 0 and game_index.canonical_name(game_name) != target_name:
             continue
-        if send_running_tables:
-            await send_active_tables_list(message, bga_account, table, game_name)
+        tables_to_send.append((table, game_name))
+    if send_running_tables:
+        await send_active_tables_list(message, bga_account, tables_to_send, fresh=fresh)
+    logger.debug(f"Table cache stats: tables {tables_cache.stats()}, table pages {table_metadata_cache.stats()}")
     for sent_message in sent_messages:  # Only delete all status messages once we're done
         await sent_message.delete()
     if len(player_tables) == 0:
@@ -92,32 +91,38 @@ async def get_tables_by_players(players, message, send_running_tables=True, game
             elif not is_player_added:
                 players_list.append(player_name)
         await message.channel.send(f"No {game_target} tables found for players [{', '.join(players_list)}].")
-    bga_account.close_connection()
+    await bga_account.close_connection()
+
+
+async def send_active_tables_list(message, bga_account, tables_to_send, fresh=False):
+    """Fetch table metadata concurrently and send one status line per table.
+    Lines are sent in table order as soon as they and the ones before them are ready."""
+    semaphore = asyncio.Semaphore(TABLE_METADATA_CONCURRENCY)
 
+    async def get_msg_limited(table, game_name):
+        async with semaphore:
+            return await get_active_table_msg(bga_account, table, game_name, fresh)
 
-def get_bga_alias(game_name):
-    # BGA uses different names *in game* than for game creation, so recognize this.
-    aliases = {
-        "redsevengame": "red7",
-        "sechsnimmt": "6nimmt",
-        "sevenwonders": "7wonders",
-        "sevenwondersduel": "7wondersduel",
-        "yatzy": "yahtzee",  # `yatzy` is due to it initially using the French name due to copyright concerns
-        "arnak": "lostruinsofarnak",
-    }
-    if normalize_name(game_name) in aliases:
-        return aliases[normalize_name(game_name)]
-    return normalize_name(game_name)
+    tasks = [asyncio.ensure_future(get_msg_limited(table, game_name)) for table, game_name in tables_to_send]
+    try:
+        for task in tasks:
+            msg_to_send = await task
+            logger.debug("Sending:" + msg_to_send)
+            await message.channel.send(msg_to_send)
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
-async def send_active_tables_list(message, bga_account, table, game_name):
+async def get_active_table_msg(bga_account, table, game_name, fresh=False):
+    """Create the status line for a table."""
     # If a game has not started, but it is scheduled, it will be None here.
     if table["gamestart"]:
         gamestart = table["gamestart"]
     else:
         gamestart = table["scheduled"]
     days_age = (datetime.datetime.utcnow() - datetime.datetime.fromtimestamp(int(gamestart))).days
-    percent_done, num_moves, table_url = bga_account.get_table_metadata(table)
+    percent_done, num_moves, table_url = await bga_account.get_table_metadata(table, fresh=fresh)
     percent_text = ""
     if percent_done:  # If it's at 0%, we won't get a number
         percent_text = f"\t\tat {percent_done}%"
@@ -128,6 +133,4 @@ async def send_active_tables_list(message, bga_account, table, game_name):
         # if table["players"][p_id]["table_order"] == str(table["current_player_nbr"]):
         #    p_name = '**' + p_name + ' to play**'
         p_names.append(p_name)
-    msg_to_send = f"__{game_name}__\t\t[{', '.join(p_names)}]\t\t{days_age} days old {percent_text}\t\t{num_moves} moves\n\t\t<{table_url}>\n"
-    logger.debug("Sending:" + msg_to_send)
-    await message.channel.send(msg_to_send)
+    return f"__{game_name}__\t\t[{', '.join(p_names)}]\t\t{days_age} days old {percent_text}\t\t{num_moves} moves\n\t\t<{table_url}>\n"
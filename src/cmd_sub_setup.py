@@ -2,7 +2,7 @@ import json
 
 from bga_account import BGAAccount, SPEED_VALUES, MODE_VALUES, LEVEL_VALUES, KARMA_VALUES
 from bga_game_list import is_game_valid
-from creds_iface import get_all_logins
+from creds_iface import get_login
 from discord_utils import send_options_embed
 from tfm_create_game import AVAILABLE_TFM_OPTIONS
 from creds_iface import save_data
@@ -12,7 +12,7 @@ from utils import normalize_name, reset_context
 
 async def ctx_setup(message, contexts, args):
     """Provide the menu to do things with status."""
-    context = contexts[str(message.author)]["context"]
+    context = contexts[message.author.id]["context"]
     if context == "setup":
         if message.content.isdigit() and message.content >= "1" and message.content <= "5":
             await parse_setup_menu(message, contexts)
@@ -27,28 +27,29 @@ async def ctx_setup(message, contexts, args):
         await message.channel.send(f"Username set to `{message.content}`")
         await send_main_setup_menu(message, contexts)
     elif context == "bga password":
-        logins = get_all_logins()
-        if not logins[str(message.author.id)]["username"]:
+        user_data = get_login(message.author.id)
+        if not user_data or not user_data.get("username"):
             await message.channel.send("You must first enter your username before entering a password.")
-            contexts[str(message.author)]["context"] = "setup"
+            contexts[message.author.id]["context"] = "setup"
             return
         account = BGAAccount()
-        login_successful = await account.login(logins[str(message.author.id)]["username"], message.content)
+        login_successful = await account.login(user_data["username"], message.content)
         await account.logout()
+        await account.close_connection()
         if login_successful:
             save_data(message.author.id, password=message.content)
             await message.channel.send("BGA username/password verified and password saved.")
             await send_main_setup_menu(message, contexts)
         else:
             await message.channel.send("BGA did not like that username/password combination. Not saving password.")
-            contexts[str(message.author)]["context"] = ""
+            contexts[message.author.id]["context"] = ""
             await send_main_setup_menu(message, contexts)
     elif context == "bga global prefs":
         await ctx_bga_parse_options(message, contexts)
     elif context == "bga choose game prefs":
         game_name = message.content
         if await is_game_valid(game_name):
-            contexts[str(message.author)]["bga prefs for game"] = normalize_name(game_name)
+            contexts[message.author.id]["bga prefs for game"] = normalize_name(game_name)
             await ctx_bga_options_menu(message, contexts, option_name=game_name + " option")
         else:
             await message.channel.send(
@@ -70,8 +71,8 @@ async def ctx_setup(message, contexts, args):
             await message.channel.send(ret_msg)
 
         game_prefs_name = ""
-        if "bga prefs for game" in contexts[str(message.author)]:
-            game_prefs_name = contexts[str(message.author)]["bga prefs for game"]
+        if "bga prefs for game" in contexts[message.author.id]:
+            game_prefs_name = contexts[message.author.id]["bga prefs for game"]
         is_interactive_session_over = True
         if context in ["presentation", "players", "restrictgroup", "lang"]:
             options = {context: message.content}
@@ -98,17 +99,13 @@ async def ctx_setup(message, contexts, args):
             is_interactive_session_over = False
         if is_interactive_session_over:
             # Keep on going until user hits cancel
-            reset_context(contexts, message.author)
+            reset_context(contexts, message.author.id)
             await send_main_setup_menu(message, contexts)
 
 
 async def send_main_setup_menu(message, contexts):
     opt_type = "option"
-    logins = get_all_logins()
-    if str(message.author.id) in logins:
-        user_data = get_all_logins()[str(message.author.id)]
-    else:
-        user_data = {}
+    user_data = get_login(message.author.id) or {}
     if "username" in user_data:
         desc = f"**User**: `{user_data['username']}`"
     else:
@@ -136,29 +133,29 @@ async def send_main_setup_menu(message, contexts):
         "Set Terraforming Mars default preferences",
     ]
     await send_options_embed(message, opt_type, options, description=desc)
-    contexts[str(message.author)]["context"] = "setup"
+    contexts[message.author.id]["context"] = "setup"
 
 
 async def parse_setup_menu(message, contexts):
     if message.content == "1":
-        contexts[str(message.author)]["context"] = "bga username"
+        contexts[message.author.id]["context"] = "bga username"
         await message.channel.send("Enter your BGA username")
     elif message.content == "2":
-        contexts[str(message.author)]["context"] = "bga password"
+        contexts[message.author.id]["context"] = "bga password"
         await message.channel.send("Enter your BGA password")
     elif message.content == "3":
         await ctx_bga_options_menu(message, contexts)
     elif message.content == "4":
         await message.channel.send("What game should these preferences be saved for?")
-        contexts[str(message.author)]["context"] = "bga choose game prefs"
+        contexts[message.author.id]["context"] = "bga choose game prefs"
     elif message.content == "5":
-        contexts[str(message.author)]["context"] = "tfm options"
+        contexts[message.author.id]["context"] = "tfm options"
         await send_options_embed(message, "TFM option", AVAILABLE_TFM_OPTIONS)
-        contexts[str(message.author)]["context"] = "tfm choose game prefs"
+        contexts[message.author.id]["context"] = "tfm choose game prefs"
 
 
 async def ctx_bga_options_menu(message, contexts, option_name="BGA option"):
-    contexts[str(message.author)]["context"] = "bga global prefs"
+    contexts[message.author.id]["context"] = "bga global prefs"
     bga_options = [
         "Mode",
         "Speed",
@@ -175,32 +172,32 @@ async def ctx_bga_options_menu(message, contexts, option_name="BGA option"):
 
 async def ctx_bga_parse_options(message, contexts):
     if message.content == "1":
-        contexts[str(message.author)]["context"] = "mode"
+        contexts[message.author.id]["context"] = "mode"
         await send_options_embed(message, "mode of play", MODE_VALUES)
     elif message.content == "2":
-        contexts[str(message.author)]["context"] = "speed"
+        contexts[message.author.id]["context"] = "speed"
         await send_options_embed(message, "game speed", SPEED_VALUES)
     elif message.content == "3":
-        contexts[str(message.author)]["context"] = "karma"
+        contexts[message.author.id]["context"] = "karma"
         await send_options_embed(message, "min karma", KARMA_VALUES)
     elif message.content == "4":
         if message.author.name in CONTRIBUTORS:
-            contexts[str(message.author)]["context"] = "presentation"
+            contexts[message.author.id]["context"] = "presentation"
             await message.channel.send("What presentation should your games have?")
         else:
             await message.channel.send("Setting presentation is reserved for contributors.")
     elif message.content == "5":
-        contexts[str(message.author)]["context"] = "players"
+        contexts[message.author.id]["context"] = "players"
         await message.channel.send("How many players (For 2 to 5 players, type `2-5`)?")
     elif message.content == "6":
-        contexts[str(message.author)]["context"] = "min level"
+        contexts[message.author.id]["context"] = "min level"
         await send_options_embed(message, "min level", LEVEL_VALUES)
     elif message.content == "7":
-        contexts[str(message.author)]["context"] = "max level"
+        contexts[message.author.id]["context"] = "max level"
         await send_options_embed(message, "max level", LEVEL_VALUES)
     elif message.content == "8":
-        contexts[str(message.author)]["context"] = "restrictgroup"
+        contexts[message.author.id]["context"] = "restrictgroup"
         await message.channel.send("What is the name of the BGA group to restrict by?")
     elif message.content == "9":
-        contexts[str(message.author)]["context"] = "lang"
+        contexts[message.author.id]["context"] = "lang"
         await message.channel.send("What 2 letter language code to set to?")
@@ -0,0 +1,125 @@
+"""Keep track of each user's interactive session, keyed by discord user id.
+
+Sessions expire EVICT_AFTER seconds after they were last touched. Expired sessions are removed by a
+periodic sweep of a heap ordered by expiry, so users who never come back don't stay in memory.
+"""
+import asyncio
+import heapq
+import time
+
+# Interactive operations time out after this many seconds (see main.on_message)
+CONTEXT_TIMEOUT = 300
+# Keep timed out sessions around a little longer so the user can be told that their operation timed out
+EVICT_AFTER = 2 * CONTEXT_TIMEOUT
+SWEEP_INTERVAL = 30
+MAX_SESSIONS = 10000
+
+
+class ContextSession:
+    """One user's interactive state. Behaves like the dict it wraps."""
+
+    __slots__ = ("user_id", "data", "expires_at", "on_close")
+
+    def __init__(self, user_id, data, expires_at):
+        self.user_id = user_id
+        self.data = data
+        self.expires_at = expires_at
+        self.on_close = []  # Functions to call when the session is replaced or evicted
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def close(self):
+        for callback in self.on_close:
+            callback()
+        self.on_close = []
+
+
+class ContextStore:
+    """{user id: ContextSession} with timer based eviction and a cap on the number of sessions."""
+
+    def __init__(self, evict_after=EVICT_AFTER, max_sessions=MAX_SESSIONS):
+        self.evict_after = evict_after
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.expiry_heap = []  # (expires_at, user_id). Stale entries are skipped when popped.
+        self.sweeper = None
+
+    def __contains__(self, user_id):
+        session = self.sessions.get(user_id)
+        return session is not None and session.expires_at > time.time()
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        return self.sessions[user_id]
+
+    def __setitem__(self, user_id, data):
+        """Start a new session for the user with data (a dict)."""
+        self.remove(user_id)
+        session = ContextSession(user_id, data, 0)
+        self.sessions[user_id] = session
+        self.touch(user_id)
+        while len(self.sessions) > self.max_sessions:
+            self.evict_next()
+        self.start_sweeper()
+
+    def __delitem__(self, user_id):
+        self.remove(user_id)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def touch(self, user_id):
+        """Push back the expiry of a user's session because they are still using it."""
+        session = self.sessions[user_id]
+        session.expires_at = time.time() + self.evict_after
+        heapq.heappush(self.expiry_heap, (session.expires_at, user_id))
+
+    def remove(self, user_id):
+        session = self.sessions.pop(user_id, None)
+        if session is not None:
+            session.close()
+
+    def evict_next(self):
+        """Remove the session that expires soonest."""
+        while self.expiry_heap:
+            expires_at, user_id = heapq.heappop(self.expiry_heap)
+            session = self.sessions.get(user_id)
+            if session is not None and session.expires_at == expires_at:
+                self.remove(user_id)
+                return
+
+    def sweep(self):
+        now = time.time()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self.expiry_heap)
+            session = self.sessions.get(user_id)
+            if session is not None and session.expires_at == expires_at:
+                self.remove(user_id)
+
+    def start_sweeper(self):
+        if self.sweeper is not None and not self.sweeper.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.sweeper = asyncio.ensure_future(self.sweep_forever())
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
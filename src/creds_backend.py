@@ -0,0 +1,166 @@
+"""Places to persist encrypted user data.
+
+FernetBlobBackend is the original format: every user in one Fernet-encrypted json blob (`bga_keys`).
+SQLiteBackend stores one row per discord user, each with its own Fernet-encrypted json payload,
+so saving one user doesn't re-encrypt everyone else.
+"""
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import sqlite3
+import stat
+
+from cryptography.fernet import Fernet
+from keys import FERNET_KEY
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+BLOB_PATH = "src/bga_keys"
+SQLITE_PATH = "src/bga_keys.sqlite3"
+
+
+class FernetBlobBackend:
+    """All users in one encrypted json blob. Any change rewrites the whole file."""
+
+    def __init__(self, path=BLOB_PATH):
+        self.path = path
+        self.users = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load_all(self):
+        """Get the login details from the encrypted text store."""
+        cipher_suite = Fernet(FERNET_KEY)
+        if self.exists():
+            with open(self.path, "rb") as f:
+                encrypted_text = f.read()
+                text = cipher_suite.decrypt(encrypted_text).decode("utf-8")
+        else:
+            text = "{}"
+        self.users = json.loads(text)
+        return dict(self.users)  # Changes to this backend's copy only happen in put_many/delete_many
+
+    def put(self, discord_id, user):
+        self.put_many({discord_id: user})
+
+    def put_many(self, users):
+        for discord_id, user in users.items():
+            self.users[str(discord_id)] = user
+        self.write()
+
+    def delete(self, discord_id):
+        self.delete_many([discord_id])
+
+    def delete_many(self, discord_ids):
+        for discord_id in discord_ids:
+            self.users.pop(str(discord_id), None)
+        self.write()
+
+    def write(self):
+        """Write the user json given the text.
+        Write a temp file and rename it over the old one so a crash never leaves a partial file."""
+        cipher_suite = Fernet(FERNET_KEY)
+        updated_text = json.dumps(self.users)
+        reencrypted_text = cipher_suite.encrypt(bytes(updated_text, encoding="utf-8"))
+        tmp_path = self.path + ".tmp"
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        with os.fdopen(os.open(tmp_path, flags, stat.S_IRUSR | stat.S_IWUSR), "wb") as f:
+            f.write(reencrypted_text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)  # Make the rename itself durable
+        finally:
+            os.close(dir_fd)
+
+
+class SQLiteBackend:
+    """One row per user with an individually encrypted payload.
+    The lowercase BGA username is stored in the clear (BGA names are public) so it can be indexed."""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.cipher_suite = Fernet(FERNET_KEY)
+        is_new = not os.path.exists(path)
+        # Writes happen in the offload worker pool, one batch at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if is_new:
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users (discord_id TEXT PRIMARY KEY, username_lower TEXT, payload BLOB NOT NULL)",
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_username_lower ON users (username_lower)")
+        self.conn.commit()
+
+    def encrypt(self, user):
+        return self.cipher_suite.encrypt(bytes(json.dumps(user), encoding="utf-8"))
+
+    def decrypt(self, payload):
+        return json.loads(self.cipher_suite.decrypt(payload).decode("utf-8"))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def load_all(self):
+        rows = self.conn.execute("SELECT discord_id, payload FROM users")
+        return {discord_id: self.decrypt(payload) for discord_id, payload in rows}
+
+    def get(self, discord_id):
+        row = self.conn.execute("SELECT payload FROM users WHERE discord_id = ?", (str(discord_id),)).fetchone()
+        if row is None:
+            return None
+        return self.decrypt(row[0])
+
+    def find_discord_id(self, bga_username):
+        """Get the discord id of the user with this BGA username or None."""
+        row = self.conn.execute(
+            "SELECT discord_id FROM users WHERE username_lower = ?",
+            (bga_username.lower(),),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, discord_id, user):
+        self.put_many({discord_id: user})
+
+    def put_many(self, users):
+        rows = [
+            (str(discord_id), user.get("username", "").lower(), self.encrypt(user)) for discord_id, user in users.items()
+        ]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", rows)
+
+    def delete(self, discord_id):
+        self.delete_many([discord_id])
+
+    def delete_many(self, discord_ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM users WHERE discord_id = ?", [(str(d),) for d in discord_ids])
+
+    def migrate_from(self, blob_backend):
+        """One-time copy of users from a bga_keys blob. The blob is renamed so it isn't migrated again."""
+        users = blob_backend.load_all()
+        self.put_many(users)
+        migrated_path = blob_backend.path + ".migrated"
+        os.replace(blob_backend.path, migrated_path)
+        logger.info(f"Migrated {len(users)} users from {blob_backend.path} to {self.path} (old file at {migrated_path})")
+
+
+def get_backend(backend_type="sqlite"):
+    """Get the configured backend, migrating from the bga_keys blob the first time sqlite is used."""
+    blob_backend = FernetBlobBackend()
+    if backend_type == "blob":
+        return blob_backend
+    backend = SQLiteBackend()
+    if blob_backend.exists() and backend.count() == 0:
+        backend.migrate_from(blob_backend)
+    return backend
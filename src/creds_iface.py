@@ -1,25 +1,44 @@
-"""Save logins locally in an encrypted file called 'bga_keys'.
-Interact with the credentials file called `bga_kys`"""
-import json
-import os
-import stat
-
-from cryptography.fernet import Fernet
-from keys import FERNET_KEY
+"""Save logins locally in an encrypted store (see creds_backend).
+Interact with the stored credentials."""
+import asyncio
+import copy
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+import traceback
+
 from bga_account import BGAAccount
+from creds_backend import get_backend
+from bga_player_cache import player_id_cache
+from bga_session_pool import session_pool
+from guild_index import get_guild_index
+from offload import run_blocking
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# "sqlite" (one encrypted row per user) or "blob" (the original single encrypted bga_keys file)
+CREDS_BACKEND = "sqlite"
+# Seconds to wait for more saves before writing, so a burst of preference changes is one write
+WRITE_COALESCE_DELAY = 0.5
+WRITE_RETRY_DELAY = 5
+# BGA sessions last a long time with "remember me", and BGA telling us a session expired is handled anyway
+SAVED_COOKIES_TTL = 7 * 24 * 3600
 
 
 def get_discord_id(bga_name, message):
     """Search through logins to find the discord id for a bga name."""
-    users = get_all_logins()
-    for discord_id in users:
-        if users[discord_id]["username"].lower() == bga_name.lower():
-            return discord_id
+    discord_id = credential_store.find_discord_id(bga_name)
+    if discord_id is not None:
+        return discord_id
     # Search for discord id if BGA name == discord nickname and it's not a private DM
     if str(message.channel.type) != "private":
-        for member in message.guild.members:
-            if member.display_name.lower().startswith(bga_name.lower()):
-                return member.id
+        return get_guild_index(message.guild).find_prefix(bga_name)
     return -1
 
 
@@ -32,99 +51,218 @@ def save_data(
     bga_global_options=[],
     tfm_global_options=[],
     bga_game_options={},
+    bga_cookies=[],
 ):
     """save data."""
     user_json = get_all_logins()
+    if purge_data or bga_global_options or bga_game_options:
+        credential_store.bump_prefs_version(discord_id)
     if purge_data:
-        del user_json[str(discord_id)]
-        write_data(user_json)
+        user_json.pop(str(discord_id), None)
+        credential_store.save(discord_id)
         return
-    if str(discord_id) not in user_json:
-        user_json[str(discord_id)] = {}
+    # Change a copy and swap it in so the writer never sees a half-changed user
+    user = copy.deepcopy(user_json.get(str(discord_id), {}))
     if bga_userid:
-        user_json[str(discord_id)]["bga_userid"] = bga_userid
+        user["bga_userid"] = bga_userid
+    if (username and username != user.get("username")) or (password and password != user.get("password")):
+        # The saved cookies are logged in as the old account
+        user.pop("bga cookies", None)
     if username:
-        user_json[str(discord_id)]["username"] = username
+        user["username"] = username
+    if bga_userid and username:
+        player_id_cache.set(username, bga_userid)
     if password:
-        user_json[str(discord_id)]["password"] = password
+        user["password"] = password
     if bga_global_options:
-        if "bga options" not in user_json[str(discord_id)]:
-            user_json[str(discord_id)]["bga options"] = {}
-        user_json[str(discord_id)]["bga options"].update(bga_global_options)
+        if "bga options" not in user:
+            user["bga options"] = {}
+        user["bga options"].update(bga_global_options)
     if tfm_global_options:
-        if "tfm options" not in user_json[str(discord_id)]:
-            user_json[str(discord_id)]["tfm options"] = {}
-        user_json[str(discord_id)]["tfm options"].update(tfm_global_options)
+        if "tfm options" not in user:
+            user["tfm options"] = {}
+        user["tfm options"].update(tfm_global_options)
     if bga_game_options:
-        if "bga game options" not in user_json[str(discord_id)]:
-            user_json[str(discord_id)]["bga game options"] = {}
+        if "bga game options" not in user:
+            user["bga game options"] = {}
         game_name = list(bga_game_options.keys())[0]
-        if game_name not in user_json[str(discord_id)]["bga game options"]:
-            user_json[str(discord_id)]["bga game options"][game_name] = {}
-        user_json[str(discord_id)]["bga game options"][game_name].update(bga_game_options[game_name])
-    write_data(user_json)
+        if game_name not in user["bga game options"]:
+            user["bga game options"][game_name] = {}
+        user["bga game options"][game_name].update(bga_game_options[game_name])
+    if bga_cookies:
+        # The saved login is only as good as its first cookie to expire
+        expires = min([time.time() + SAVED_COOKIES_TTL] + [c["expires"] for c in bga_cookies if c.get("expires")])
+        user["bga cookies"] = {"cookies": bga_cookies, "expires": expires, "username": user.get("username", "")}
+    user_json[str(discord_id)] = user
+    credential_store.save(discord_id)
+
+
+class CredentialStore:
+    """Decrypted user data, read from the backend once and kept in memory.
+    Every change to a user is written through to the backend with save()."""
+
+    def __init__(self, backend_type=CREDS_BACKEND):
+        self.backend_type = backend_type
+        self.backend = None
+        self.users = None
+        self.queue = None  # discord ids with changes to write
+        self.writer = None
+        self.usernames = {}  # {"lowercase bga username": "discord id"}
+        self.user_usernames = {}  # {"discord id": "lowercase bga username"} to update the above
+        self.prefs_versions = {}  # {"discord id": number of preference changes}, so caches of prefs know they changed
+
+    def get_all(self):
+        if self.users is None:
+            self.backend = get_backend(self.backend_type)
+            self.set_users(self.backend.load_all())
+        return self.users
+
+    async def load(self):
+        """Decrypt all users in the worker pool. Call once on startup so commands don't have to."""
+        if self.users is None:
+            self.backend = await run_blocking("load credentials", get_backend, self.backend_type)
+            self.set_users(await run_blocking("decrypt credentials", self.backend.load_all))
+
+    def set_users(self, users):
+        self.users = users
+        for discord_id in self.users:
+            self.index_username(discord_id)
+
+    def index_username(self, discord_id):
+        old_username = self.user_usernames.pop(discord_id, None)
+        if old_username is not None and self.usernames.get(old_username) == discord_id:
+            del self.usernames[old_username]
+        username = self.users.get(discord_id, {}).get("username", "").lower()
+        if username:
+            self.usernames[username] = discord_id
+            self.user_usernames[discord_id] = username
+
+    def find_discord_id(self, bga_username):
+        """Get the discord id of the user with this BGA username or None."""
+        self.get_all()
+        return self.usernames.get(bga_username.lower())
+
+    def get(self, discord_id):
+        """Get a copy of a user's data (so callers can change it without changing the store) or None."""
+        return copy.deepcopy(self.get_all().get(str(discord_id)))
+
+    def bump_prefs_version(self, discord_id):
+        discord_id = str(discord_id)
+        self.prefs_versions[discord_id] = self.prefs_versions.get(discord_id, 0) + 1
+
+    def save(self, discord_id):
+        """Persist the changes to one user (or their deletion).
+        In the bot, changes are queued and written by one writer task so that bursts become one write."""
+        discord_id = str(discord_id)
+        self.get_all()
+        self.index_username(discord_id)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:  # Not running in the bot, so just write it
+            self.write({discord_id})
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.ensure_future(self.write_pending())
+        self.queue.put_nowait(discord_id)
+
+    async def write_pending(self):
+        while True:
+            discord_ids = {await self.queue.get()}
+            await asyncio.sleep(WRITE_COALESCE_DELAY)  # Let other saves in this burst arrive
+            while not self.queue.empty():
+                discord_ids.add(self.queue.get_nowait())
+            # Users are replaced rather than changed in place, so this snapshot is safe to use in another thread
+            users = self.get_all()
+            snapshot = {d: users.get(d) for d in discord_ids}
+            try:
+                await run_blocking("encrypt credentials", self.write_snapshot, snapshot)
+            except Exception as e:
+                logger.error(f"Unable to save {len(discord_ids)} users, retrying: {e}\n{traceback.format_exc()}")
+                await asyncio.sleep(WRITE_RETRY_DELAY)
+                for discord_id in discord_ids:
+                    self.queue.put_nowait(discord_id)
+
+    def write(self, discord_ids):
+        users = self.get_all()
+        self.write_snapshot({d: users.get(d) for d in discord_ids})
 
+    def write_snapshot(self, snapshot):
+        """Write {discord id: user} where a user of None means it was deleted."""
+        updated_users = {d: user for d, user in snapshot.items() if user is not None}
+        if updated_users:
+            self.backend.put_many(updated_users)
+        deleted_ids = [d for d, user in snapshot.items() if user is None]
+        if deleted_ids:
+            self.backend.delete_many(deleted_ids)
 
-def write_data(user_json):
-    """Write the user json given the text."""
-    cipher_suite = Fernet(FERNET_KEY)
-    updated_text = json.dumps(user_json)
-    reencrypted_text = cipher_suite.encrypt(bytes(updated_text, encoding="utf-8"))
-    with os.fdopen(os.open("src/bga_keys", os.O_WRONLY | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR), "wb") as f:
-        f.write(reencrypted_text)
+
+credential_store = CredentialStore()
 
 
 def get_all_logins():
-    """Get the login details from the encrypted text store."""
-    cipher_suite = Fernet(FERNET_KEY)
-    if os.path.exists("src/bga_keys"):
-        with open("src/bga_keys", "rb") as f:
-            encrypted_text = f.read()
-            text = cipher_suite.decrypt(encrypted_text).decode("utf-8")
-    else:
-        text = "{}"
-    user_json = json.loads(text)
-    return user_json
+    """Get the login details of all users. This is the store's own dict, so don't change it directly."""
+    return credential_store.get_all()
+
+
+async def load_credentials():
+    """Decrypt the credential store on startup."""
+    await credential_store.load()
+
+
+def seed_player_cache():
+    """Add the BGA ids of users who have run !setup to the player id cache."""
+    users = get_all_logins()
+    player_id_cache.seed([(user.get("username"), user.get("bga_userid")) for user in users.values()])
 
 
 def purge_data(discord_id):
     """Delete a specific user from the user json blob"""
     save_data(discord_id, purge_data=True)
+    session_pool.discard(discord_id)
 
 
 def get_login(discord_id):
     """Get login info for a specific user."""
-    discord_id_str = str(discord_id)
-    logins = get_all_logins()
-    if discord_id_str in logins:
-        return logins[discord_id_str]
-    return None
+    return credential_store.get(discord_id)
+
+
+def get_prefs_version(discord_id):
+    """Get a number that changes every time a user's BGA preferences are saved."""
+    return credential_store.prefs_versions.get(str(discord_id), 0)
 
 
 async def setup_bga_account(message, bga_username, bga_password):
-    """Save and verify login info."""
-    # Delete account info posted on a public channel
+    """Save and verify login info. The message with the password is deleted by main.on_message."""
     discord_id = message.author.id
-    if message.guild:
-        await message.delete()
     account = BGAAccount()
-    logged_in = account.login(bga_username, bga_password)
-    player_id = account.get_player_id(bga_username)
-    account.logout()
-    account.close_connection()
+    logged_in = await account.login(bga_username, bga_password)
+    player_id = await account.get_player_id(bga_username)
     if logged_in:
-        save_data(discord_id, bga_userid=player_id, username=bga_username, password=bga_password)
+        save_data(
+            discord_id,
+            bga_userid=player_id,
+            username=bga_username,
+            password=bga_password,
+            bga_cookies=account.export_cookies(),
+        )
+        account.saved_login_count = account.login_count
+        # Keep the session so the user's next command doesn't need to log in again
+        session_pool.put(discord_id, account)
         await message.channel.send(
             f"Account {bga_username} setup successfully. This bot will store your username and password so that you can make tables with !play. To play chess with pocc, use `!play chess pocc`",
         )
     else:
+        await account.close_connection()
         await message.author.send(
             'Unable to setup account because of bad username or password. Try putting quotes (") around either if there are spaces or special characters.',
         )
 
 
 async def get_active_session(discord_id):
-    """Get an active session with the author's login info."""
+    """Get an active session with the author's login info.
+    Sessions are shared between commands, so callers should not log out or close them."""
     login_info = get_login(discord_id)
     if not login_info:
         return (
@@ -134,12 +272,28 @@ async def get_active_session(discord_id):
     # bogus_password ("") means no password present
     if login_info["password"] == "":
         return None, "You have to sign in to host a game. Run `!bga` to get info on setup."
-    account = BGAAccount()
-    logged_in = account.login(login_info["username"], login_info["password"])
-    if logged_in:
+    saved_cookies = get_saved_cookies(login_info)
+    account = await session_pool.get(discord_id, login_info["username"], login_info["password"], saved_cookies)
+    if account:
+        save_cookies(discord_id, account)
         return account, None
     else:
         return (
             None,
             'This account was set up with a bad username or password. DM the bga bot with `!bga setup "username" "pass"`.',
         )
+
+
+def get_saved_cookies(login_info):
+    """Get the cookies saved from the user's last login if they haven't expired and are for the same account, or None."""
+    saved = login_info.get("bga cookies")
+    if not saved or saved["expires"] < time.time() or saved.get("username") != login_info["username"]:
+        return None
+    return saved["cookies"]
+
+
+def save_cookies(discord_id, account):
+    """Save the account's cookies if it logged in since they were last saved, so a restart doesn't need a login."""
+    if account.login_count != account.saved_login_count:
+        account.saved_login_count = account.login_count
+        save_data(discord_id, bga_cookies=account.export_cookies())
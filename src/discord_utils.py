@@ -12,6 +12,11 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+# Discord rejects embeds over these limits
+MAX_FIELDS = 25
+MAX_FIELD_CHARS = 1000  # 1024, with room for the "...and N more" line
+MAX_EMBED_CHARS = 5500  # 6000, with room for the title and field names
+
 
 async def send_table_embed(message, game, desc, author, players, second_title, second_content):
     """Create a discord embed to send the message about table creation."""
@@ -62,3 +67,29 @@ async def send_simple_embed(message, title, description="", fields={}):
         retmsg.add_field(name=field, value=fields[field], inline=False)
     retmsg.set_footer(text="Type cancel to quit")
     await message.author.send(embed=retmsg)
+
+
+async def send_summary_embed(message, title, lines, description=""):
+    """Send one embed to the channel with a line per item, split into fields that fit in discord's limits.
+    Lines that don't fit are counted at the end instead."""
+    retmsg = discord.Embed(
+        title=title,
+        color=3447003,
+    )
+    if description:
+        retmsg.description = description
+    fields = [""]
+    total_chars = len(title) + len(description)
+    for i, line in enumerate(lines):
+        is_field_full = len(fields[-1]) + len(line) >= MAX_FIELD_CHARS
+        if total_chars + len(line) > MAX_EMBED_CHARS or (is_field_full and len(fields) == MAX_FIELDS):
+            fields[-1] += f"\n...and {len(lines) - i} more"
+            break
+        if is_field_full:
+            fields.append("")
+        fields[-1] += "\n" + line
+        total_chars += len(line) + 1
+    for field in fields:
+        if field:
+            retmsg.add_field(name="\u200b", value=field, inline=False)  # Field names can't be empty
+    await message.channel.send(embed=retmsg)
@@ -0,0 +1,60 @@
+"""Index the display names of guild members so that BGA names can be matched to discord members.
+
+Indexes are built the first time a guild is searched and then kept current from member events.
+"""
+import bisect
+
+
+class GuildMemberIndex:
+    """Sorted lowercase display names of one guild's members for prefix lookups."""
+
+    def __init__(self, members):
+        self.names = {member.id: member.display_name.lower() for member in members}
+        self.entries = sorted((name, member_id) for member_id, name in self.names.items())
+
+    def add(self, member):
+        if member.id in self.names:
+            self.remove(member.id)
+        name = member.display_name.lower()
+        self.names[member.id] = name
+        bisect.insort(self.entries, (name, member.id))
+
+    def remove(self, member_id):
+        name = self.names.pop(member_id, None)
+        if name is None:
+            return
+        pos = bisect.bisect_left(self.entries, (name, member_id))
+        if pos < len(self.entries) and self.entries[pos] == (name, member_id):
+            del self.entries[pos]
+
+    def find_prefix(self, prefix):
+        """Get the id of a member whose display name starts with prefix (case insensitive) or -1."""
+        prefix = prefix.lower()
+        pos = bisect.bisect_left(self.entries, (prefix,))
+        if pos < len(self.entries) and self.entries[pos][0].startswith(prefix):
+            return self.entries[pos][1]
+        return -1
+
+
+guild_indexes = {}
+
+
+def get_guild_index(guild):
+    if guild.id not in guild_indexes:
+        guild_indexes[guild.id] = GuildMemberIndex(guild.members)
+    return guild_indexes[guild.id]
+
+
+def member_added(member):
+    """Call when a member joins or changes their display name."""
+    if member.guild.id in guild_indexes:
+        guild_indexes[member.guild.id].add(member)
+
+
+def member_removed(member):
+    if member.guild.id in guild_indexes:
+        guild_indexes[member.guild.id].remove(member.id)
+
+
+def guild_removed(guild):
+    guild_indexes.pop(guild.id, None)
@@ -0,0 +1,126 @@
+"""Run long bot commands (like !play, which talks to BGA many times) on a bounded pool of workers.
+
+Jobs are taken round-robin from each guild's queue, and a user only has one job running at a time,
+so one busy guild or user can't starve everyone else. When the queue is full, new jobs are refused.
+"""
+import asyncio
+from collections import OrderedDict, deque
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+import traceback
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+JOB_WORKERS = 8
+MAX_QUEUED = 200
+MAX_QUEUED_PER_USER = 3
+# Number of recent jobs to use for wait time stats
+WAIT_SAMPLES = 200
+
+
+class Job:
+    def __init__(self, message, function, args_list):
+        self.message = message
+        self.function = function
+        self.args_list = args_list
+        self.user_id = message.author.id
+        self.guild_key = message.guild.id if message.guild else "private"
+        self.enqueued_at = time.time()
+
+
+class JobQueue:
+    """Bounded worker pool with per-guild round-robin and one running job per user."""
+
+    def __init__(self, workers=JOB_WORKERS, max_queued=MAX_QUEUED, max_queued_per_user=MAX_QUEUED_PER_USER):
+        self.num_workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.guild_queues = OrderedDict()  # {guild id: deque of jobs}
+        self.queued = 0
+        self.queued_per_user = {}
+        self.running_users = set()
+        self.running = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.condition = None
+        self.workers = []
+
+    async def submit(self, message, function, args_list):
+        """Queue function(*args_list) to run for this message. Tells the user if they have to wait."""
+        self.start()
+        job = Job(message, function, args_list)
+        if self.queued >= self.max_queued or self.queued_per_user.get(job.user_id, 0) >= self.max_queued_per_user:
+            logger.info(f"Refused job from {job.user_id} because the queue is full: {self.stats()}")
+            await message.channel.send("The bot is too busy right now. Try again in a minute.")
+            return
+        async with self.condition:
+            self.guild_queues.setdefault(job.guild_key, deque()).append(job)
+            self.queued += 1
+            self.queued_per_user[job.user_id] = self.queued_per_user.get(job.user_id, 0) + 1
+            position = self.queued
+            is_overloaded = self.running >= self.num_workers or job.user_id in self.running_users
+            self.condition.notify()
+        if is_overloaded:
+            await message.channel.send(f"Queued, position {position}.")
+
+    def start(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.num_workers)]
+
+    def next_job(self):
+        """Take the next job from the next guild in round-robin order whose user isn't already running a job."""
+        for _ in range(len(self.guild_queues)):
+            guild_key, jobs = next(iter(self.guild_queues.items()))
+            self.guild_queues.move_to_end(guild_key)
+            for job in jobs:
+                if job.user_id not in self.running_users:
+                    jobs.remove(job)
+                    if not jobs:
+                        del self.guild_queues[guild_key]
+                    return job
+        return None
+
+    async def work(self):
+        while True:
+            async with self.condition:
+                job = self.next_job()
+                while job is None:
+                    await self.condition.wait()
+                    job = self.next_job()
+                self.queued -= 1
+                self.queued_per_user[job.user_id] -= 1
+                if self.queued_per_user[job.user_id] == 0:
+                    del self.queued_per_user[job.user_id]
+                self.running_users.add(job.user_id)
+                self.running += 1
+            self.waits.append(time.time() - job.enqueued_at)
+            logger.debug(f"Starting job for {job.user_id} after {self.waits[-1]:.2f}s in queue. {self.stats()}")
+            try:
+                await job.function(*job.args_list)
+            except Exception as e:
+                logger.error(f"Job for {job.user_id} failed: {e}\n{traceback.format_exc()}")
+            finally:
+                async with self.condition:
+                    self.running_users.discard(job.user_id)
+                    self.running -= 1
+                    self.condition.notify_all()  # A job of this user may be runnable now
+
+    def stats(self):
+        waits = list(self.waits)
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "avg wait": sum(waits) / len(waits) if waits else 0,
+            "max wait": max(waits) if waits else 0,
+        }
+
+
+job_queue = JobQueue()
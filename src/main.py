@@ -1,20 +1,29 @@
 #!/usr/bin/env python3
 """Bot to create games on discord."""
+import asyncio
 import logging.handlers
 import time
 import traceback
 import shlex
 
 import discord
-from bga_game_list import bga_game_message_list, is_game_valid
+from bga_account import close_shared_connector
+from bga_game_list import bga_game_message_list, is_game_valid, game_list_refresher
 from bga_table_status import get_tables_by_players
+from bga_bulk_create import bulk_create_command
 from bga_create_game import setup_bga_game
+from bga_health import BGAUnavailableError, bga_circuit, bga_latency
 from bga_message import send_message
-from creds_iface import setup_bga_account
+from bga_ratelimit import BGARateLimitError, request_scheduler
+from bga_session_pool import session_pool
+from creds_iface import setup_bga_account, seed_player_cache, load_credentials
 from bga_add_friend import add_friends
+from guild_index import member_added, member_removed, guild_removed
+from job_queue import job_queue
 from keys import TOKEN
 from tfm_create_game import init_tfm_game
 from menu_root import trigger_interactive_response
+from context_store import ContextStore
 from utils import send_help, force_double_quotes
 
 LOG_FILENAME = "errs"
@@ -31,7 +40,10 @@ SUBCOMMANDS = [
     "!purge",
     "!message",
     "!msg",
+    "!bulk",
 ]
+# Seconds between logging how BGA and the bot's queues are doing
+HEALTH_LOG_INTERVAL = 600
 logger = logging.getLogger(__name__)
 logging.getLogger("discord").setLevel(logging.WARN)
 # Add the log message handler to the logger
@@ -41,20 +53,72 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+
+class BotClient(discord.Client):
+    async def close(self):
+        """Close the pooled BGA sessions and the connector they share when the bot shuts down."""
+        await session_pool.close_all()
+        await close_shared_connector()
+        await super().close()
+
+
 intents = discord.Intents(messages=True, guilds=True, members=True)
-client = discord.Client(intents=intents)
-# Keep track of context in global variable {"<author id>": {"context": context, "timestamp": int timestamp}}
-contexts = {}
+client = BotClient(intents=intents)
+# Keep track of context in global variable {<author id>: {"context": context, "timestamp": int timestamp}}
+contexts = ContextStore()
+health_logger = None
 
 
 @client.event
 async def on_ready():
     """Let the user who started the bot know that the connection succeeded."""
     logger.info(f"{client.user.name} has connected to Discord, and is active on {len(client.guilds)} servers!")
+    await load_credentials()
+    seed_player_cache()
+    game_list_refresher.start()
+    start_health_logger()
     listening_to_help = discord.Activity(type=discord.ActivityType.listening, name="!help")
     await client.change_presence(activity=listening_to_help)
 
 
+def start_health_logger():
+    """Periodically log the stats of the game list refresher, BGA requests and the job queue.
+    on_ready runs again on reconnects, so only start one."""
+    global health_logger
+    if health_logger is None or health_logger.done():
+        health_logger = asyncio.ensure_future(log_health())
+
+
+async def log_health():
+    while True:
+        await asyncio.sleep(HEALTH_LOG_INTERVAL)
+        logger.info(
+            f"Health: game list {game_list_refresher.status()}, BGA requests {request_scheduler.stats()}, "
+            f"BGA circuit {bga_circuit.stats()}, BGA latency {bga_latency.stats()}, jobs {job_queue.stats()}"
+        )
+
+
+@client.event
+async def on_member_join(member):
+    member_added(member)
+
+
+@client.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        member_added(after)
+
+
+@client.event
+async def on_member_remove(member):
+    member_removed(member)
+
+
+@client.event
+async def on_guild_remove(guild):
+    guild_removed(guild)
+
+
 @client.event
 async def on_message(message):
     """Listen to messages so that this bot can do something."""
@@ -68,44 +132,46 @@ async def on_message(message):
         log_received_message(message)
         if message.content.startswith("!tfm"):
             await try_catch(message, init_tfm_game, [message])
+        # Pairings are on separate lines or in an attachment, so don't split the message like other commands
+        elif message.content.startswith("!bulk"):
+            await job_queue.submit(message, try_catch, [message, bulk_create_command, [message]])
         # separate from other bga commands because we don't want to strip ' and " from message
         elif message.content.startswith("!msg") or message.content.startswith("!message"):
             if message.content.count(" ") >= 2:  # equivalent to checking for 3+ args
-                args = message.content.split(" ")
-                dest_author_name = args[1]
-                message_content = " ".join(args[2:])
-                ret_msg = await send_message(message.author.id, dest_author_name, message_content)
-                await message.channel.send(ret_msg)
+                await job_queue.submit(message, try_catch, [message, message_command, [message]])
             else:
                 await message.channel.send(
                     "You must specify both a user and a message like `!message friendo Let's play can't stop!`.",
                 )
         else:
+            # Delete account info posted on a public channel right away, not when the queued job starts
+            if message.content.startswith("!setup") and message.guild and len(message.content.split()) > 1:
+                await try_catch(message, message.delete, [])
             # Preserve command syntax and when there are missing args, go interactive
             try:
                 # Replace quotes and strip white space to sanitize arguments
                 message.content = force_double_quotes(message.content)
                 args = shlex.split(message.content)
                 args = [arg.strip() for arg in args]
-                await try_catch(message, trigger_bga_action, [message, args])
+                await job_queue.submit(message, try_catch, [message, trigger_bga_action, [message, args]])
             except ValueError as e:
                 await message.channel.send("Problem parsing command: " + str(e))
     # Use a contexts variable to keep track of next step for user.
     # this can be anything the user sends to the bot and needs to be parsed according to the context.
     elif str(message.channel.type) == "private" and message.channel.me == client.user:
         log_received_message(message)
-        safe_to_check_timestamp = str(message.author) in contexts and "timestamp" in contexts[str(message.author)]
-        if str(message.author) not in contexts:
+        safe_to_check_timestamp = message.author.id in contexts and "timestamp" in contexts[message.author.id]
+        if message.author.id not in contexts:
             await try_catch(message, trigger_interactive_response, [message, contexts, "", []])
-        elif safe_to_check_timestamp and contexts[str(message.author)]["timestamp"] > time.time() - 300:
-            if "subcommand" in contexts[str(message.author)] and contexts[str(message.author)]["subcommand"]:
-                command = contexts[str(message.author)]["subcommand"]
+        elif safe_to_check_timestamp and contexts[message.author.id]["timestamp"] > time.time() - 300:
+            if "subcommand" in contexts[message.author.id] and contexts[message.author.id]["subcommand"]:
+                command = contexts[message.author.id]["subcommand"]
             else:
                 command = message.content.split(" ")[0][1:]  # remove leading ! for command
             interactive_args = [message, contexts, command, []]
             await try_catch(message, trigger_interactive_response, interactive_args)
-        elif "context" in contexts[str(message.author)]:
-            await message.channel.send(f"Operation timed out for operation {contexts[str(message.author)]['context']}")
+        elif "context" in contexts[message.author.id]:
+            await message.channel.send(f"Operation timed out for operation {contexts[message.author.id]['context']}")
             await try_catch(message, trigger_interactive_response, [message, contexts, "timeout", []])
         else:
             await try_catch(message, trigger_interactive_response, [message, contexts, "timeout", []])
@@ -118,9 +184,9 @@ def log_received_message(message):
     as well as !setup when the context is `bga password`
     """
     is_context_bga_password = (
-        str(message.author) in contexts
-        and "context" in contexts[str(message.author)]
-        and contexts[str(message.author)] == "bga password"
+        message.author.id in contexts
+        and "context" in contexts[message.author.id]
+        and contexts[message.author.id] == "bga password"
     )
     if not is_context_bga_password:
         msg = message.content
@@ -150,13 +216,26 @@ async def try_catch(message, function, args_list):
             )
         else:
             await message.channel.send("Operation failed due to problem with permissions: " + e.text)
+    except BGAUnavailableError as e:
+        await message.channel.send(str(e))
+    except BGARateLimitError:
+        await message.channel.send("The bot is sending too many requests to BGA right now. Try again in a minute.")
     except Exception as e:
         logger.error("Encountered error:" + str(e) + "\n" + str(traceback.format_exc()))
         await message.channel.send("Tell <@!234561564697559041> to fix his bga bot.")
 
 
+async def message_command(message):
+    """!msg: send a BGA message to a player."""
+    args = message.content.split(" ")
+    dest_author_name = args[1]
+    message_content = " ".join(args[2:])
+    ret_msg = await send_message(message.author.id, dest_author_name, message_content)
+    await message.channel.send(ret_msg)
+
+
 async def trigger_bga_action(message, args):
-    author = str(message.author)
+    author = message.author.id
     command = args[0][1:]
     args.remove(args[0])
     noninteractive_commands = ["list", "help", "options"]
@@ -181,12 +260,15 @@ async def trigger_bga_action(message, args):
             await message.channel.send(errs)
     elif command == "status" and len(args) >= 2:
         game = ""  # if game isn't specified, then bot will search for all games
+        fresh = "--fresh" in args  # Don't use cached table data
+        if fresh:
+            args.remove("--fresh")
         for arg in args:
             if await is_game_valid(arg):
                 game = arg
                 args.remove(game)
         players = args  # remaining args will all of the players
-        await get_tables_by_players(players, message, game_target=game)
+        await get_tables_by_players(players, message, game_target=game, fresh=fresh)
     elif command == "friend" and len(args) >= 2:
         await add_friends(args[1:], message)
     elif command == "list":
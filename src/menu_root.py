@@ -1,6 +1,6 @@
 """Interact with the bot if you are missing options in your command.
 
-This works by changing the global `contexts` for a discord user for every message they send.
+This works by changing the global `contexts` (a context_store.ContextStore) for a discord user for every message they send.
 Each message that is meaningful to the bot will change the context.
 Each different context will route them to the appropriate location.
 """
@@ -51,7 +51,7 @@ async def trigger_interactive_response(message, contexts, curr_ctx, args):
         purge_data(str(message.author.id))
         await message.channel.send(f"Deleted data for {message.author.name}.")
         return
-    author = str(message.author)
+    author = message.author.id
     if message.content.startswith("cancel"):
         # quit current interactive session
         await message.channel.send("Canceled operation")
@@ -64,7 +64,7 @@ async def trigger_interactive_response(message, contexts, curr_ctx, args):
             "subcommand": curr_ctx,
             "context": "",
             "timestamp": time.time(),
-            "channel": message.channel,
+            "channel_id": message.channel.id,
             "menu": "",
         }
         in_five_min_window = True
@@ -72,6 +72,7 @@ async def trigger_interactive_response(message, contexts, curr_ctx, args):
         in_five_min_window = contexts[author]["timestamp"] > time.time() - 300
     if in_five_min_window:
         contexts[author]["timestamp"] = time.time()  # reset timer
+        contexts.touch(author)
         if contexts[author]["subcommand"] == "choose subprogram":
             if message.content.isdigit() and "1" <= message.content <= "3":
                 contexts[author]["subcommand"] = ["setup", "play", "status"][int(message.content) - 1]
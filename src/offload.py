@@ -0,0 +1,49 @@
+"""Run CPU-heavy work (encryption, big json dumps, regex over big pages) off of the event loop.
+
+Every job is timed so that slow jobs show up in the logs and in job_stats.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from logging.handlers import RotatingFileHandler
+import time
+
+LOG_FILENAME = "errs"
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10000000, backupCount=0)
+formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s | %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+OFFLOAD_WORKERS = 4
+# Log jobs that take longer than this many seconds
+SLOW_JOB_SECONDS = 0.1
+
+executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS, thread_name_prefix="offload")
+# {"label": {"count": int, "total": seconds, "max": seconds}}
+job_stats = {}
+
+
+def record_job(label, duration):
+    stats = job_stats.setdefault(label, {"count": 0, "total": 0.0, "max": 0.0})
+    stats["count"] += 1
+    stats["total"] += duration
+    stats["max"] = max(stats["max"], duration)
+    if duration > SLOW_JOB_SECONDS:
+        logger.debug(f"Offloaded job {label} took {duration:.3f}s")
+
+
+async def run_blocking(label, func, *args):
+    """Run func(*args) in the worker pool and return its result. Only the time spent running is recorded."""
+    loop = asyncio.get_running_loop()
+
+    def timed():
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            duration = time.perf_counter() - start
+            loop.call_soon_threadsafe(record_job, label, duration)
+
+    return await loop.run_in_executor(executor, timed)
@@ -0,0 +1,57 @@
+"""Collapse identical concurrent requests into one.
+
+When several commands ask BGA the same question at the same time (like !status for the same players
+at the start of game night), only the first one makes the request and the others wait for its result.
+Results are also kept for a few seconds so that requests that arrive right after are free too.
+"""
+import asyncio
+import time
+
+MICRO_CACHE_TTL = 5
+MAX_RESULTS = 1000
+
+
+class SingleFlight:
+    """Share in-flight calls and recent results by key."""
+
+    def __init__(self, ttl=MICRO_CACHE_TTL, max_results=MAX_RESULTS):
+        self.ttl = ttl
+        self.max_results = max_results
+        self.in_flight = {}  # {key: future}
+        self.results = {}  # {key: (expiry, result)}
+        self.shared = 0  # Calls that didn't need their own request
+
+    async def do(self, key, coro_func, *args):
+        """Get the result of await coro_func(*args), sharing it with other calls that use the same key."""
+        if key in self.results:
+            expiry, result = self.results[key]
+            if expiry > time.time():
+                self.shared += 1
+                return result
+            del self.results[key]
+        if key in self.in_flight:
+            self.shared += 1
+        else:
+            self.in_flight[key] = asyncio.ensure_future(self.call(key, coro_func, *args))
+        # Shield so that one caller giving up doesn't cancel the request for everyone else
+        return await asyncio.shield(self.in_flight[key])
+
+    async def call(self, key, coro_func, *args):
+        try:
+            result = await coro_func(*args)
+        finally:
+            del self.in_flight[key]
+        if self.ttl > 0:
+            if len(self.results) >= self.max_results:
+                self.prune()
+            self.results[key] = (time.time() + self.ttl, result)
+        return result
+
+    def prune(self):
+        now = time.time()
+        self.results = {key: value for key, value in self.results.items() if value[0] > now}
+        while len(self.results) >= self.max_results:
+            del self.results[next(iter(self.results))]
+
+    def forget(self, key):
+        self.results.pop(key, None)
@@ -0,0 +1,35 @@
+"""Size-bounded LRU cache whose entries expire after a TTL."""
+from collections import OrderedDict
+import time
+
+
+class TTLCache:
+    """{key: value} that forgets values after ttl seconds and drops the least recently used past max_entries."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {key: (expiry, value)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get the cached value or None."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -12,9 +12,9 @@ def is_url(url):
         return False
 
 
-def reset_context(contexts, author):
+def reset_context(contexts, author_id):
     """End the current interactive session by deleting info about it."""
-    contexts[author] = {}
+    contexts[author_id] = {}
 
 
 async def send_help(message, help_type):